@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""Load generator for the vote app and the chat WebSocket backend.
+
+Drives either target with asyncio clients and prints throughput and latency
+percentiles as JSON. Two load models are supported:
+
+* closed loop (default): ``--concurrency`` clients each send their next
+  request as soon as the previous one completes, optionally capped by
+  ``--rate`` overall;
+* open loop (``--open-loop``): requests arrive at ``--rate`` per second
+  (evenly spaced, or exponentially with ``--poisson``) whether or not
+  earlier ones have finished. Latency is measured from the scheduled
+  arrival time, so queueing delay is not hidden.
+
+With ``--local`` the target is started in-process on a free port, backed
+by fakeredis (and mongomock for the chat backend), so regressions can be
+caught without a cluster.
+
+Usage:
+    python benchmarks/loadgen.py vote --local --duration 10
+    python benchmarks/loadgen.py vote --url http://localhost:8080/ --open-loop --rate 500
+    python benchmarks/loadgen.py chat --local --users 50 --rate 200
+    python benchmarks/loadgen.py chat --url ws://localhost:5000 --users 10 --concurrency 10
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VOTE_APP_DIR = os.path.join(REPO_ROOT, 'example-voting-app-main', 'vote')
+CHAT_APP_DIR = os.path.join(REPO_ROOT, 'kubernetes-assignment', 'backend')
+
+
+class Recorder:
+    """Collects per-request latencies and error counts"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.started = None
+        self.finished = None
+
+    def ok(self, seconds):
+        self.latencies.append(seconds)
+
+    def error(self):
+        self.errors += 1
+
+    def summary(self, target, args):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        ordered = sorted(self.latencies)
+
+        def pct(p):
+            if not ordered:
+                return 0.0
+            index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+            return round(ordered[index] * 1000, 3)
+
+        return {
+            'target': target,
+            'model': 'open' if args.open_loop else 'closed',
+            'rate': args.rate,
+            'concurrency': args.concurrency,
+            'duration_s': round(elapsed, 3),
+            'completed': len(ordered),
+            'errors': self.errors,
+            'throughput_per_s': round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+            'latency_ms': {
+                'mean': round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0,
+                'p50': pct(50),
+                'p90': pct(90),
+                'p99': pct(99),
+                'max': pct(100),
+            },
+        }
+
+
+async def run_load(args, recorder, issue):
+    """Call ``issue(scheduled_at)`` according to the selected load model"""
+    recorder.started = time.perf_counter()
+    deadline = recorder.started + args.duration
+
+    if args.open_loop:
+        if not args.rate:
+            raise SystemExit('--open-loop needs --rate')
+        in_flight = set()
+        next_at = recorder.started
+        while next_at < deadline:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.create_task(issue(next_at))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            gap = random.expovariate(args.rate) if args.poisson else 1.0 / args.rate
+            next_at += gap
+        if in_flight:
+            await asyncio.wait(in_flight, timeout=args.drain_timeout)
+    else:
+        interval = args.concurrency / args.rate if args.rate else 0
+
+        async def client():
+            next_at = time.perf_counter()
+            while time.perf_counter() < deadline:
+                if interval:
+                    delay = next_at - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    next_at += interval
+                await issue(time.perf_counter())
+
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    recorder.finished = time.perf_counter()
+
+
+# --- vote app ---------------------------------------------------------------
+
+async def bench_vote(args):
+    import httpx
+
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.concurrency if not args.open_loop else None)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        async def issue(scheduled_at):
+            vote = 'a' if random.random() < args.ratio_a else 'b'
+            cookies = {'voter_id': '%x' % random.getrandbits(64)} if args.unique_voters else None
+            try:
+                response = await client.post('/', data={'vote': vote}, cookies=cookies)
+                if response.status_code == 200:
+                    recorder.ok(time.perf_counter() - scheduled_at)
+                else:
+                    recorder.error()
+            except httpx.HTTPError:
+                recorder.error()
+
+        await run_load(args, recorder, issue)
+    return recorder.summary('vote', args)
+
+
+# --- chat backend -------------------------------------------------------------
+
+async def bench_chat(args):
+    import websockets
+
+    recorder = Recorder()
+    users = ['user%d' % i for i in range(args.users)]
+    pending = {}  # message id -> (scheduled_at, future)
+    ids = itertools.count()
+    sockets = {}
+
+    async def reader(ws):
+        async for frame in ws:
+            try:
+                message = json.loads(frame)
+            except ValueError:
+                continue
+            # With WS_COALESCE_WINDOW set, a frame may carry several messages
+            for message in message if isinstance(message, list) else [message]:
+                entry = pending.pop(message.get('text'), None)
+                if entry:
+                    scheduled_at, done = entry
+                    recorder.ok(time.perf_counter() - scheduled_at)
+                    if not done.done():
+                        done.set_result(None)
+
+    base = args.url.rstrip('/')
+    for user in users:
+        sockets[user] = await websockets.connect(f'{base}/ws/{user}', max_queue=None)
+    readers = [asyncio.create_task(reader(ws)) for ws in sockets.values()]
+    await asyncio.sleep(0.2)  # let welcome and presence messages drain
+
+    async def issue(scheduled_at):
+        sender, recipient = random.sample(users, 2)
+        message_id = 'bench-%d' % next(ids)
+        done = asyncio.get_running_loop().create_future()
+        pending[message_id] = (scheduled_at, done)
+        try:
+            await sockets[sender].send(json.dumps({'to': recipient, 'text': message_id}))
+            await asyncio.wait_for(done, args.timeout)
+        except (asyncio.TimeoutError, websockets.ConnectionClosed):
+            pending.pop(message_id, None)
+            recorder.error()
+
+    try:
+        await run_load(args, recorder, issue)
+    finally:
+        for task in readers:
+            task.cancel()
+        await asyncio.gather(*(ws.close() for ws in sockets.values()), return_exceptions=True)
+    return recorder.summary('chat', args)
+
+
+# --- in-process targets ------------------------------------------------------
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve_asgi(app, port, **config):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning', **config))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def serve_wsgi(app, port):
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_local_vote(args):
+    import fakeredis
+
+    sys.path.insert(0, VOTE_APP_DIR)
+    port = free_port()
+    if args.app == 'async':
+        import fakeredis.aioredis
+        import async_app
+        async_app.redis_client = fakeredis.aioredis.FakeRedis()
+        async_app.app.logger.setLevel(logging.WARNING)
+        serve_asgi(async_app.app, port)
+    else:
+        import app as vote_app
+        vote_app.redis_client = fakeredis.FakeRedis()
+        vote_app.app.logger.setLevel(logging.WARNING)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        serve_wsgi(vote_app.app, port)
+    return f'http://127.0.0.1:{port}'
+
+
+def start_local_chat(args):
+    import fakeredis
+    import fakeredis.aioredis
+    import mongomock
+    import pymongo
+    import redis
+    import redis.asyncio
+
+    # Route the backend's Redis and MongoDB clients to in-process stand-ins
+    server = fakeredis.FakeServer()
+    redis.Redis = lambda *a, **kw: fakeredis.FakeRedis(server=server, decode_responses=True)
+    redis.asyncio.Redis = lambda *a, **kw: fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+    mongo = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *a, **kw: mongo
+
+    def command(self, command, *a, **kw):
+        if command in ('ping', 'ismaster'):
+            return {'ok': 1.0}
+        raise NotImplementedError(command)
+    mongomock.database.Database.command = command
+
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    # Measure the backend, not its per-connection rate limit
+    os.environ.setdefault('RATE_LIMIT_PER_SECOND', '0')
+    sys.path.insert(0, CHAT_APP_DIR)
+    import server as chat_server
+    port = free_port()
+    # Same WebSocket protocol and compression settings as server.py's __main__
+    serve_asgi(chat_server.app, port, ws=chat_server.ChatWebSocketProtocol,
+               ws_per_message_deflate=chat_server.WS_COMPRESSION)
+    return f'ws://127.0.0.1:{port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('target', choices=['vote', 'chat'])
+    parser.add_argument('--url', help='target base URL (http:// for vote, ws:// for chat)')
+    parser.add_argument('--local', action='store_true',
+                        help='start the target in-process against fakeredis/mongomock')
+    parser.add_argument('--app', choices=['wsgi', 'async'], default='wsgi',
+                        help='which vote app to start with --local')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to generate load')
+    parser.add_argument('--rate', type=float, default=0, help='requests or messages per second (0 = unthrottled)')
+    parser.add_argument('--concurrency', type=int, default=20, help='closed-loop clients')
+    parser.add_argument('--open-loop', action='store_true', help='fixed arrival rate instead of closed-loop clients')
+    parser.add_argument('--poisson', action='store_true', help='exponential inter-arrival times in open-loop mode')
+    parser.add_argument('--timeout', type=float, default=10, help='per-request timeout in seconds')
+    parser.add_argument('--drain-timeout', type=float, default=10,
+                        help='seconds to wait for in-flight open-loop requests at the end')
+    parser.add_argument('--ratio-a', type=float, default=2 / 3, help='fraction of votes for option a')
+    parser.add_argument('--unique-voters', action='store_true', help='send a fresh voter_id with every vote')
+    parser.add_argument('--users', type=int, default=10, help='simulated chat users')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    if args.local:
+        args.url = start_local_vote(args) if args.target == 'vote' else start_local_chat(args)
+    elif not args.url:
+        args.url = 'http://localhost:8080' if args.target == 'vote' else 'ws://localhost:5000'
+    if args.target == 'chat' and args.users < 2:
+        parser.error('--users must be at least 2')
+
+    report = asyncio.run(bench_vote(args) if args.target == 'vote' else bench_chat(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Benchmark the per-message serialization work in the chat backend.
+
+``legacy`` replays the old chain for one chat message: json.loads of the
+frame, json.dumps for direct delivery, json.dumps for Redis, json.loads in
+the listener and a fresh json.dumps before the second send_text.
+``envelope`` is the current path, run through the backend's own
+``build_envelope``, ``encode_relay`` and ``decode_relay``: one orjson.loads
+of the frame, one orjson.dumps of the canonical envelope, and a small
+routing header that the listener splits off without touching the envelope.
+
+Reports CPU time per message and the peak memory traced while handling one
+message (tracemalloc).
+
+Usage:
+    python benchmarks/message_relay.py --count 200000
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import orjson
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHAT_APP_DIR = os.path.join(REPO_ROOT, 'kubernetes-assignment', 'backend')
+FRAME = json.dumps({'to': 'B', 'text': 'Hello there, how is the deployment going today?'})
+
+
+def legacy(frame):
+    message_data = json.loads(frame)
+    message_data['from'] = 'A'
+    message_data['timestamp'] = datetime.now().isoformat()
+    direct = json.dumps({
+        'from': message_data.get('from'),
+        'text': message_data.get('text'),
+        'timestamp': message_data.get('timestamp')
+    })
+    redis_message = json.dumps(message_data)
+    data = json.loads(redis_message)
+    relayed = json.dumps({
+        'from': data.get('from'),
+        'text': data.get('text'),
+        'timestamp': data.get('timestamp')
+    })
+    return direct, relayed
+
+
+def envelope_path():
+    import server
+
+    def envelope(frame):
+        message_data = orjson.loads(frame)
+        message_data['from'] = 'A'
+        envelope_text = orjson.dumps(server.build_envelope(message_data)).decode()
+        redis_message = server.encode_relay(envelope_text, 'A', time.time(), 'B')
+        relayed = server.decode_relay(redis_message)[4]
+        return envelope_text, relayed
+
+    return envelope
+
+
+def measure(fn, count):
+    for _ in range(1000):
+        fn(FRAME)
+    started = time.process_time()
+    for _ in range(count):
+        fn(FRAME)
+    cpu = time.process_time() - started
+
+    # Peak traced memory while handling one message, averaged over a sample
+    sample = min(count, 5000)
+    tracemalloc.start()
+    total = 0
+    for _ in range(sample):
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(FRAME)
+        total += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return {
+        'cpu_us_per_message': round(cpu / count * 1e6, 3),
+        'peak_bytes_per_message': round(total / sample),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, CHAT_APP_DIR)
+    logging.disable(logging.CRITICAL)
+
+    results = {'legacy': measure(legacy, args.count), 'envelope': measure(envelope_path(), args.count)}
+    results['cpu_reduction'] = round(
+        1 - results['envelope']['cpu_us_per_message'] / results['legacy']['cpu_us_per_message'], 3)
+    results['peak_memory_reduction'] = round(
+        1 - results['envelope']['peak_bytes_per_message'] / results['legacy']['peak_bytes_per_message'], 3)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""Benchmark the chat backend's Redis pub/sub listener.
+
+Compares the old busy-poll loop (synchronous ``pubsub.get_message()`` plus
+``asyncio.sleep(0.01)``) with the asyncio-native subscriber now used by
+``kubernetes-assignment/backend/server.py``. A publisher thread pushes
+timestamped chat messages onto ``chat_messages`` and each listener forwards
+them to a fake WebSocket, which records the publish-to-send latency.
+
+Usage:
+    python benchmarks/redis_listener.py --fake            # in-process fakeredis
+    python benchmarks/redis_listener.py --redis-url redis://localhost:6379/0
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+import redis
+import redis.asyncio as aioredis
+
+CHANNEL = 'chat_messages'
+
+
+class FakeWebSocket:
+    """Stands in for a connected client and records delivery latency"""
+
+    def __init__(self):
+        self.latencies = []
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def send_text(self, text):
+        data = json.loads(text)
+        self.latencies.append(time.perf_counter() - data['sent'])
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+
+def deliver(data, sockets):
+    user_id = data.get('to')
+    if user_id in sockets:
+        return sockets[user_id].send_text(json.dumps({
+            'from': data.get('from'),
+            'text': data.get('text'),
+            'sent': data.get('sent')
+        }))
+    return None
+
+
+async def polling_listener(sync_client, sockets, ready):
+    """The pre-asyncio listener: poll the socket and sleep between polls"""
+    pubsub = sync_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(CHANNEL)
+    ready.set()
+    try:
+        while True:
+            message = pubsub.get_message()
+            if message and message['type'] == 'message':
+                send = deliver(json.loads(message['data']), sockets)
+                if send is not None:
+                    await send
+            await asyncio.sleep(0.01)
+    finally:
+        pubsub.close()
+
+
+async def asyncio_listener(async_client, sockets, ready):
+    """The asyncio-native listener: await the socket, drain buffered replies"""
+    pubsub = async_client.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(CHANNEL)
+    ready.set()
+    try:
+        while True:
+            message = await pubsub.get_message(timeout=None)
+            if message and message['type'] == 'message':
+                send = deliver(json.loads(message['data']), sockets)
+                if send is not None:
+                    await send
+    finally:
+        await pubsub.close()
+
+
+def publisher(sync_client, count, rate):
+    interval = 1.0 / rate if rate else 0
+    next_at = time.perf_counter()
+    for i in range(count):
+        if interval:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_at += interval
+        sync_client.publish(CHANNEL, json.dumps({
+            'from': 'A',
+            'to': 'B',
+            'text': f'message {i}',
+            'sent': time.perf_counter()
+        }))
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_mode(mode, sync_client, async_client, count, rate, timeout):
+    socket = FakeWebSocket()
+    socket.expected = count
+    sockets = {'B': socket}
+    ready = asyncio.Event()
+    if mode == 'polling':
+        listener = asyncio.create_task(polling_listener(sync_client, sockets, ready))
+    else:
+        listener = asyncio.create_task(asyncio_listener(async_client, sockets, ready))
+    await ready.wait()
+
+    started = time.perf_counter()
+    thread = threading.Thread(target=publisher, args=(sync_client, count, rate), daemon=True)
+    thread.start()
+    try:
+        await asyncio.wait_for(socket.done.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+    listener.cancel()
+    try:
+        await listener
+    except asyncio.CancelledError:
+        pass
+    thread.join()
+
+    received = len(socket.latencies)
+    return {
+        'mode': mode,
+        'published': count,
+        'delivered': received,
+        'seconds': round(elapsed, 3),
+        'messages_per_sec': round(received / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(socket.latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(socket.latencies, 99) * 1000, 3),
+    }
+
+
+def build_clients(args):
+    if args.fake:
+        import fakeredis
+        import fakeredis.aioredis
+        server = fakeredis.FakeServer()
+        return (fakeredis.FakeRedis(server=server, decode_responses=True),
+                fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+    return (redis.Redis.from_url(args.redis_url, decode_responses=True),
+            aioredis.Redis.from_url(args.redis_url, decode_responses=True))
+
+
+async def main(args):
+    sync_client, async_client = build_clients(args)
+    results = []
+    for mode in args.modes:
+        results.append(await run_mode(mode, sync_client, async_client,
+                                      args.count, args.rate, args.timeout))
+    await async_client.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/0')
+    parser.add_argument('--fake', action='store_true', help='use an in-process fakeredis server')
+    parser.add_argument('--count', type=int, default=2000, help='messages to publish per mode')
+    parser.add_argument('--rate', type=float, default=0, help='publish rate in msg/s (0 = unthrottled)')
+    parser.add_argument('--timeout', type=float, default=60, help='give up on a mode after this many seconds')
+    parser.add_argument('--modes', nargs='+', default=['polling', 'asyncio'],
+                        choices=['polling', 'asyncio'])
+    asyncio.run(main(parser.parse_args()))
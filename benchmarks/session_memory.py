@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Benchmark per-connection memory in the chat backend's connection registry.
+
+``parallel-dicts`` keeps the same per-connection state as the backend, but
+spread over one dict per field keyed by user ID (the layout the registry
+would need without session objects). ``sessions`` registers
+``server.Session`` objects with the real ``ConnectionManager`` and heartbeat
+wheel. WebSocket objects are created up front and are not counted.
+
+Reports traced bytes per connection and the cost of registering and tearing
+down one connection.
+
+Usage:
+    python benchmarks/session_memory.py --sessions 100000
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHAT_APP_DIR = os.path.join(REPO_ROOT, 'kubernetes-assignment', 'backend')
+RATE_LIMIT_BURST = 20
+
+
+class FakeWebSocket:
+    __slots__ = ()
+
+
+def parallel_dicts(users, sockets):
+    state = {name: {} for name in (
+        'websocket', 'connected_at', 'last_seen', 'pinged_at', 'slot',
+        'tokens', 'updated', 'throttled', 'messages_in', 'messages_out', 'outbox')}
+
+    def add():
+        for user_id, websocket in zip(users, sockets):
+            now = time.time()
+            state['websocket'][user_id] = websocket
+            state['connected_at'][user_id] = now
+            state['last_seen'][user_id] = now
+            state['pinged_at'][user_id] = None
+            state['slot'][user_id] = 0
+            state['tokens'][user_id] = float(RATE_LIMIT_BURST)
+            state['updated'][user_id] = time.monotonic()
+            state['throttled'][user_id] = False
+            state['messages_in'][user_id] = 0
+            state['messages_out'][user_id] = 0
+            state['outbox'][user_id] = None
+
+    def remove():
+        for user_id in users:
+            for field in state.values():
+                del field[user_id]
+
+    return add, remove
+
+
+def sessions(users, sockets):
+    import server
+
+    manager = server.manager
+    registered = []
+
+    def add():
+        for user_id, websocket in zip(users, sockets):
+            session = server.Session(user_id, 0, websocket)
+            manager.register(session)
+            registered.append(session)
+
+    def remove():
+        for session in registered:
+            manager.unregister(session)
+        registered.clear()
+
+    return add, remove
+
+
+def measure(layout, count):
+    users = ['user%d' % i for i in range(count)]
+    sockets = [FakeWebSocket() for _ in range(count)]
+    add, remove = layout(users, sockets)
+
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    add()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    remove()
+
+    # Timed separately, since tracing slows allocation down
+    started = time.perf_counter()
+    add()
+    added = time.perf_counter() - started
+    started = time.perf_counter()
+    remove()
+    removed = time.perf_counter() - started
+    return {
+        'connections': count,
+        'bytes_per_connection': round(used / count),
+        'total_mib': round(used / 2 ** 20, 1),
+        'register_us': round(added / count * 1e6, 3),
+        'teardown_us': round(removed / count * 1e6, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=100000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, CHAT_APP_DIR)
+    logging.disable(logging.CRITICAL)
+
+    results = {
+        'parallel-dicts': measure(parallel_dicts, args.sessions),
+        'sessions': measure(sessions, args.sessions),
+    }
+    results['memory_reduction'] = round(
+        1 - results['sessions']['bytes_per_connection'] / results['parallel-dicts']['bytes_per_connection'], 3)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
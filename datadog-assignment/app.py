@@ -1,10 +1,195 @@
-from flask import Flask, request
+from flask import Flask, request, g
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import time
+from datetime import datetime, timezone
+from request_profiler import RequestProfiler
 
 app = Flask(__name__)
+# Per-route latency and sampled flamegraphs on /_profiler
+RequestProfiler(app)
+
+# Log settings
+LOG_FILE = os.getenv('LOG_FILE', 'app.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+LOG_ROTATE_SECONDS = int(os.getenv('LOG_ROTATE_SECONDS', '86400'))
+LOG_BUFFER_RECORDS = int(os.getenv('LOG_BUFFER_RECORDS', '64'))
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', '1'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_DROP_REPORT_SECONDS = float(os.getenv('LOG_DROP_REPORT_SECONDS', '60'))
+
+# Per-request fields added by log_request, in Datadog's standard attribute layout
+REQUEST_FIELDS = ('http', 'network', 'duration')
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, so the agent can parse fields without a pipeline."""
+
+    def format(self, record):
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in REQUEST_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['error'] = {'stack': self.formatException(record.exc_info)}
+        return json.dumps(entry)
+
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotates by size or age and flushes every LOG_BUFFER_RECORDS records.
+
+    Only the listener thread writes, so the size is tracked here instead of
+    calling tell(), which would flush the buffer on every record.
+    """
+
+    def __init__(self, filename, max_bytes, backup_count, rotate_seconds, buffer_records):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.rotate_seconds = rotate_seconds
+        self.buffer_records = buffer_records
+        self.rollover_at = time.time() + rotate_seconds
+        self.pending = 0
+
+    def _open(self):
+        stream = super()._open()
+        self.size = os.fstat(stream.fileno()).st_size
+        return stream
+
+    def emit(self, record):
+        try:
+            # JSON output is ASCII, so characters and bytes match
+            line = self.format(record) + self.terminator
+            if self.size and ((self.maxBytes and self.size + len(line) > self.maxBytes) or
+                              (self.rotate_seconds and time.time() >= self.rollover_at)):
+                self.doRollover()
+            self.stream.write(line)
+            self.size += len(line)
+            self.pending += 1
+            if self.pending >= self.buffer_records:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        super().flush()
+        self.pending = 0
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.rotate_seconds
+
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+    """Writes records off the request path and flushes buffers once the queue goes quiet.
+
+    It also logs a warning, at most every LOG_DROP_REPORT_SECONDS, when the
+    queue handler has dropped records since the last one.
+    """
+
+    def __init__(self, log_queue, queue_handler, *handlers):
+        super().__init__(log_queue, *handlers)
+        self.queue_handler = queue_handler
+        self.reported = 0
+        self.next_report = time.monotonic() + LOG_DROP_REPORT_SECONDS
+
+    def dequeue(self, block):
+        while True:
+            self.report_dropped()
+            try:
+                return self.queue.get(timeout=LOG_FLUSH_INTERVAL)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
+
+    def report_dropped(self):
+        if time.monotonic() < self.next_report:
+            return
+        self.next_report = time.monotonic() + LOG_DROP_REPORT_SECONDS
+        dropped = self.queue_handler.dropped
+        if dropped > self.reported:
+            # Handled directly: the queue may still be full
+            self.handle(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': 'Dropped %d log records because the log writer fell behind (%d in total)',
+                'args': (dropped - self.reported, dropped),
+            }))
+            self.reported = dropped
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Drops records instead of blocking requests when the writer falls behind."""
+
+    dropped = 0
+
+    def prepare(self, record):
+        # The stock prepare() renders the traceback into the message and
+        # clears exc_info; keep it so JSONFormatter can write error.stack
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging():
+    file_handler = BufferedRotatingFileHandler(
+        LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_SECONDS, LOG_BUFFER_RECORDS)
+    file_handler.setFormatter(JSONFormatter())
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    listener = FlushingQueueListener(log_queue, queue_handler, file_handler)
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+    # Werkzeug's own access log would duplicate log_request
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    listener.start()
+    # Drains the queue and flushes the file on shutdown
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def log_request(response):
+    duration = time.perf_counter() - g.pop('request_started', time.perf_counter())
+    logging.info('%s %s %s', request.method, request.path, response.status_code, extra={
+        'http': {
+            'method': request.method,
+            'url_details': {'path': request.path},
+            'status_code': response.status_code,
+        },
+        'network': {'client': {'ip': request.remote_addr}},
+        # Datadog expects durations in nanoseconds
+        'duration': int(duration * 1e9),
+    })
+    return response
 
-# Set up logging to a file
-logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s %(message)s')
 
 @app.route('/')
 def hello():
@@ -2,6 +2,7 @@
 import json
 import asyncio
 import logging
+import os
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -24,31 +25,86 @@ logger = logging.getLogger(__name__)
 active_connections = {}
 
 
+# Outbound delivery settings. Each socket gets a bounded queue drained by its
+# own writer task, so a slow client only ever delays itself.
+SEND_QUEUE_SIZE = int(os.environ.get("SEND_QUEUE_SIZE", 100))
+# What to do when a client's queue is full: "drop-oldest" or "disconnect"
+SLOW_CONSUMER_POLICY = os.environ.get("SLOW_CONSUMER_POLICY", "drop-oldest")
+
+
+class ClientConnection:
+    """A connected socket with its own outbound queue and writer task"""
+
+    def __init__(self, websocket: WebSocket, user_id: str, on_error):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.on_error = on_error
+        self.writer_task = asyncio.create_task(self.writer())
+
+    def enqueue(self, message: str):
+        """Queue a message without waiting; returns False if the client was dropped"""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            pass
+        if SLOW_CONSUMER_POLICY == "disconnect":
+            logger.warning(f"Send queue full for {self.user_id}, disconnecting slow client")
+            self.on_error(self.user_id)
+            asyncio.create_task(self.websocket.close(code=1008))
+            return False
+        # drop-oldest: make room by discarding the stalest queued message
+        self.queue.get_nowait()
+        self.queue.put_nowait(message)
+        logger.warning(f"Send queue full for {self.user_id}, dropped oldest message")
+        return True
+
+    async def writer(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                await self.websocket.send_text(message)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error sending to {self.user_id}: {str(e)}")
+            self.on_error(self.user_id)
+
+    def close(self):
+        self.writer_task.cancel()
+
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections = {}
 
     async def connect(self, websocket: WebSocket, user_id: str):
         await websocket.accept()
-        self.active_connections[user_id] = websocket
+        previous = self.active_connections.get(user_id)
+        if previous:
+            previous.close()
+        self.active_connections[user_id] = ClientConnection(websocket, user_id, self.disconnect)
         logger.info(f"User {user_id} connected. Total connections: {len(self.active_connections)}")
 
     def disconnect(self, user_id: str):
         if user_id in self.active_connections:
-            del self.active_connections[user_id]
+            self.active_connections.pop(user_id).close()
             logger.info(f"User {user_id} disconnected. Total connections: {len(self.active_connections)}")
 
     async def send_personal_message(self, message: str, user_id: str):
         if user_id in self.active_connections:
-            await self.active_connections[user_id].send_text(message)
+            self.active_connections[user_id].enqueue(message)
             logger.info(f"Message sent to {user_id}")
         else:
             logger.warning(f"Cannot send message to {user_id}: user not connected")
 
     async def broadcast(self, message: str, exclude_user: str = None):
-        for user_id, connection in self.active_connections.items():
+        # The payload is already encoded once by the caller; enqueueing never
+        # awaits, so the cost is flat regardless of how slow any client is
+        for user_id, connection in list(self.active_connections.items()):
             if exclude_user != user_id:  # Don't send to the sender
-                await connection.send_text(message)
+                connection.enqueue(message)
 
 
 manager = ConnectionManager()
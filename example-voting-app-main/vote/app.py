@@ -1,48 +1,126 @@
-from flask import Flask, render_template, request, make_response, g
-from redis import Redis
+from flask import Flask, render_template, request, make_response
+from redis import Redis, ConnectionPool
+import atexit
 import os
-import socket
-import random
-import json
 import logging
+import threading
+from request_profiler import RequestProfiler
+from vote_common import (
+    AGGREGATE_KEYS, RECORD_VOTE_SCRIPT, VOTES_KEY, PageCache, aggregate_votes, new_voter_id,
+    page_context, queue_votes, vote_payload,
+)
 
-option_a = os.getenv('OPTION_A', "Cats")
-option_b = os.getenv('OPTION_B', "Dogs")
-hostname = socket.gethostname()
+# Coalesce votes for up to VOTE_BATCH_MS milliseconds into one pipelined
+# RPUSH; 0 pushes every vote synchronously as before
+vote_batch_ms = float(os.getenv('VOTE_BATCH_MS', 0))
+vote_batch_size = int(os.getenv('VOTE_BATCH_SIZE', 500))
 
 app = Flask(__name__)
+# Per-route latency and sampled flamegraphs on /_profiler
+RequestProfiler(app)
 
 gunicorn_error_logger = logging.getLogger('gunicorn.error')
 app.logger.handlers.extend(gunicorn_error_logger.handlers)
 app.logger.setLevel(logging.INFO)
 
+# One pool per worker process, shared by every request
+redis_pool = ConnectionPool(host="redis", db=0, socket_timeout=5)
+redis_client = Redis(connection_pool=redis_pool)
+
 def get_redis():
-    if not hasattr(g, 'redis'):
-        g.redis = Redis(host="redis", db=0, socket_timeout=5)
-    return g.redis
+    return redis_client
+
+record_vote = redis_client.register_script(RECORD_VOTE_SCRIPT)
+
+def store_votes(votes):
+    """Write a list of (voter_id, vote) pairs to Redis in one round trip"""
+    pipe = get_redis().pipeline(transaction=False)
+    if queue_votes:
+        payload = [vote_payload(voter_id, vote) for voter_id, vote in votes]
+        for start in range(0, len(payload), vote_batch_size):
+            pipe.rpush(VOTES_KEY, *payload[start:start + vote_batch_size])
+    if aggregate_votes:
+        # Only a voter's last vote in the batch matters
+        for voter_id, vote in dict(votes).items():
+            record_vote(keys=AGGREGATE_KEYS, args=[voter_id, vote], client=pipe)
+    pipe.execute()
+
+
+class VoteBatcher:
+    """Buffers votes and flushes them from a background thread in batches"""
+
+    def __init__(self, interval, max_size):
+        self.interval = interval
+        self.max_size = max_size
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def add(self, voter_id, vote):
+        with self.lock:
+            # gunicorn forks workers after import, so start the thread lazily
+            if self.pid != os.getpid():
+                self.pending = []
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.pending.append((voter_id, vote))
+            if len(self.pending) >= self.max_size:
+                self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            store_votes(batch)
+        except Exception:
+            app.logger.exception('Failed to push %d votes', len(batch))
+
+
+vote_batcher = None
+if vote_batch_ms > 0:
+    vote_batcher = VoteBatcher(vote_batch_ms / 1000.0, vote_batch_size)
+    atexit.register(vote_batcher.flush)
+
+page_cache = PageCache()
+
+def render_page(vote):
+    page = page_cache.get(vote)
+    if page is None:
+        page = page_cache.store(vote, render_template('index.html', **page_context(vote)).encode('utf-8'))
+    return page
 
 @app.route("/", methods=['POST','GET'])
 def hello():
     voter_id = request.cookies.get('voter_id')
     if not voter_id:
-        voter_id = hex(random.getrandbits(64))[2:-1]
+        voter_id = new_voter_id()
 
     vote = None
 
     if request.method == 'POST':
-        redis = get_redis()
         vote = request.form['vote']
         app.logger.info('Received vote for %s', vote)
-        data = json.dumps({'voter_id': voter_id, 'vote': vote})
-        redis.rpush('votes', data)
-
-    resp = make_response(render_template(
-        'index.html',
-        option_a=option_a,
-        option_b=option_b,
-        hostname=hostname,
-        vote=vote,
-    ))
+        if vote_batcher:
+            vote_batcher.add(voter_id, vote)
+        else:
+            store_votes([(voter_id, vote)])
+
+    body, etag = render_page(vote)
+    resp = make_response(body)
+    resp.set_etag(etag)
+    if request.method == 'GET':
+        resp.make_conditional(request)
     resp.set_cookie('voter_id', voter_id)
     return resp
 
@@ -0,0 +1,71 @@
+from quart import Quart, render_template, request, make_response
+from redis.asyncio import Redis, ConnectionPool
+import os
+import logging
+from vote_common import (
+    AGGREGATE_KEYS, RECORD_VOTE_SCRIPT, VOTES_KEY, PageCache, aggregate_votes, new_voter_id,
+    page_context, queue_votes, vote_payload,
+)
+
+# ASGI flavour of app.py: same route and template, but requests are served
+# from one event loop per process with an async Redis client, so a single
+# worker can keep hundreds of voters in flight. Run it with:
+#   uvicorn async_app:app --host 0.0.0.0 --port 80 --timeout-keep-alive 5
+
+app = Quart(__name__)
+app.logger.setLevel(logging.INFO)
+
+redis_pool = ConnectionPool(
+    host="redis", db=0, socket_timeout=5,
+    max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', 100)),
+)
+redis_client = Redis(connection_pool=redis_pool)
+
+def get_redis():
+    return redis_client
+
+record_vote = redis_client.register_script(RECORD_VOTE_SCRIPT)
+
+async def store_vote(voter_id, vote):
+    if queue_votes:
+        await get_redis().rpush(VOTES_KEY, vote_payload(voter_id, vote))
+    if aggregate_votes:
+        await record_vote(keys=AGGREGATE_KEYS, args=[voter_id, vote], client=get_redis())
+
+page_cache = PageCache()
+
+async def render_page(vote):
+    page = page_cache.get(vote)
+    if page is None:
+        page = page_cache.store(vote, (await render_template('index.html', **page_context(vote))).encode('utf-8'))
+    return page
+
+@app.route("/", methods=['POST','GET'])
+async def hello():
+    voter_id = request.cookies.get('voter_id')
+    if not voter_id:
+        voter_id = new_voter_id()
+
+    vote = None
+
+    if request.method == 'POST':
+        form = await request.form
+        vote = form['vote']
+        app.logger.info('Received vote for %s', vote)
+        await store_vote(voter_id, vote)
+
+    body, etag = await render_page(vote)
+    resp = await make_response(body)
+    resp.set_etag(etag)
+    if request.method == 'GET':
+        await resp.make_conditional(request)
+    resp.set_cookie('voter_id', voter_id)
+    return resp
+
+@app.after_serving
+async def close_redis():
+    await redis_pool.disconnect()
+
+
+if __name__ == "__main__":
+    app.run(host='0.0.0.0', port=80, debug=True)
@@ -0,0 +1,13 @@
+-- Record a voter's latest vote in the voters hash (KEYS[1]) and move their
+-- tally in KEYS[2] from the previous option to the new one, atomically.
+-- ARGV[1] is the voter ID and ARGV[2] the vote.
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+if previous == ARGV[2] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if previous then
+    redis.call('HINCRBY', KEYS[2], previous, -1)
+end
+redis.call('HINCRBY', KEYS[2], ARGV[2], 1)
+return 1
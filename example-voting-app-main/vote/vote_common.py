@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+import random
+import socket
+
+# Settings and helpers shared by app.py (Flask on gunicorn) and async_app.py
+# (Quart on uvicorn), so both serve the same page and store votes the same way
+
+option_a = os.getenv('OPTION_A', "Cats")
+option_b = os.getenv('OPTION_B', "Dogs")
+hostname = socket.gethostname()
+
+# Where votes go: "queue" pushes every vote onto the 'votes' list for the
+# worker, "aggregate" keeps only the latest vote per voter plus running
+# tallies, "both" does both while consumers migrate
+vote_ingest = os.getenv('VOTE_INGEST', 'queue')
+queue_votes = vote_ingest in ('queue', 'both')
+aggregate_votes = vote_ingest in ('aggregate', 'both')
+
+VOTES_KEY = 'votes'
+AGGREGATE_KEYS = ['voters', 'tallies']
+
+# Atomically records a voter's latest vote and moves their running tally;
+# each app registers it on its own Redis client
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'record_vote.lua')) as f:
+    RECORD_VOTE_SCRIPT = f.read()
+
+
+def new_voter_id():
+    return hex(random.getrandbits(64))[2:-1]
+
+
+def vote_payload(voter_id, vote):
+    return json.dumps({'voter_id': voter_id, 'vote': vote})
+
+
+def page_context(vote):
+    return dict(option_a=option_a, option_b=option_b, hostname=hostname, vote=vote)
+
+
+class PageCache:
+    """Rendered page variants with their ETags.
+
+    The page only varies with the vote, so each variant is rendered once per
+    process and then served from memory. Anything but the two options and
+    "no vote" is rendered per request and never cached.
+    """
+
+    CACHEABLE = (None, 'a', 'b')
+
+    def __init__(self):
+        self.pages = {}
+
+    def get(self, vote):
+        return self.pages.get(vote)
+
+    def store(self, vote, body):
+        page = (body, hashlib.sha1(body).hexdigest())
+        if vote in self.CACHEABLE:
+            self.pages[vote] = page
+        return page
@@ -0,0 +1,245 @@
+"""Request profiling for the Flask apps in this repository.
+
+Mount it on an app with ``RequestProfiler(app)``. It keeps a latency
+histogram per route and, for a sampled fraction of requests, records the
+request thread's stack every few milliseconds. The stacks are written in the
+folded format that flamegraph.pl and speedscope read. Both are served on an
+admin endpoint:
+
+    GET /_profiler              per-route latency summary (JSON)
+    GET /_profiler/flamegraph   folded stacks of the sampled requests
+    add ?reset=1 to either one to clear what has been collected
+
+Settings come from the environment:
+
+    PROFILER_SAMPLE_RATE   fraction of requests to profile (default 0, off)
+    PROFILER_INTERVAL_MS   stack sampling interval (default 5)
+    PROFILER_MAX_STACKS    distinct stacks kept; rarer ones are merged (default 10000)
+    PROFILER_PATH          admin endpoint prefix (default /_profiler)
+    PROFILER_TOKEN         if set, required in the X-Profiler-Token header;
+                           if not, only loopback clients are served
+
+Histograms cost two clock reads and a few additions per request. Stacks are
+only walked while a sampled request is running, so the profiler can stay
+mounted in production. Each process keeps its own data; under gunicorn the
+endpoint reports the worker that answers, named by its pid.
+
+The vote, datadog and my-simple-webapp-flask apps all use this one module.
+Install it with ``pip install ./flask-request-profiler``, or copy it from the
+``profiler`` build context their Dockerfiles expect.
+"""
+import bisect
+import hmac
+import ipaddress
+import os
+import random
+import sys
+import threading
+import time
+
+from flask import abort, g, jsonify, request
+
+# Upper bounds of the latency buckets, in milliseconds
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+
+def is_loopback(address):
+    try:
+        ip = ipaddress.ip_address(address or '')
+    except ValueError:
+        return False
+    return ip.is_loopback or (ip.version == 6 and ip.ipv4_mapped is not None and ip.ipv4_mapped.is_loopback)
+
+
+class RouteStats:
+    """Latency histogram of one route"""
+
+    __slots__ = ('buckets', 'count', 'total', 'max', 'errors')
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS_MS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def observe(self, elapsed_ms, failed):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        self.count += 1
+        self.total += elapsed_ms
+        if elapsed_ms > self.max:
+            self.max = elapsed_ms
+        if failed:
+            self.errors += 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket that holds the given fraction of requests"""
+        target = fraction * self.count
+        seen = 0
+        for bound, hits in zip(LATENCY_BUCKETS_MS, self.buckets):
+            seen += hits
+            if seen >= target:
+                return round(min(bound, self.max), 3)
+        return round(self.max, 3)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean_ms': round(self.total / self.count, 3) if self.count else 0,
+            'p50_ms': self.percentile(0.5),
+            'p90_ms': self.percentile(0.9),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max, 3),
+            'buckets': {str(bound): hits for bound, hits in zip(LATENCY_BUCKETS_MS, self.buckets) if hits},
+        }
+
+
+class StackSampler:
+    """Samples the stacks of registered threads from one background thread"""
+
+    def __init__(self, interval, max_stacks):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks = {}   # folded stack -> samples
+        self.active = {}   # thread ident -> root frame label
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def start(self, ident, label):
+        with self.lock:
+            # gunicorn forks workers after import, so start the thread lazily
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.active = {}
+                self.thread = threading.Thread(target=self.run, name='request-profiler', daemon=True)
+                self.thread.start()
+            self.active[ident] = label
+        self.wakeup.set()
+
+    def stop(self, ident):
+        with self.lock:
+            self.active.pop(ident, None)
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while self.active:
+                time.sleep(self.interval)
+                self.sample()
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self.lock:
+            for ident, label in list(self.active.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                names.append(label)
+                stack = ';'.join(reversed(names))
+                if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                    stack = label + ';[other]'
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def folded(self):
+        with self.lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.stacks.items()))
+
+    def reset(self):
+        with self.lock:
+            self.stacks = {}
+
+
+class RequestProfiler:
+    """Flask extension recording per-route latency and sampled request stacks"""
+
+    def __init__(self, app=None, sample_rate=None, interval_ms=None, max_stacks=None, path=None, token=None):
+        self.sample_rate = float(os.getenv('PROFILER_SAMPLE_RATE', 0) if sample_rate is None else sample_rate)
+        interval_ms = float(os.getenv('PROFILER_INTERVAL_MS', 5) if interval_ms is None else interval_ms)
+        max_stacks = int(os.getenv('PROFILER_MAX_STACKS', 10000) if max_stacks is None else max_stacks)
+        self.path = (path or os.getenv('PROFILER_PATH', '/_profiler')).rstrip('/')
+        self.token = token or os.getenv('PROFILER_TOKEN')
+        self.routes = {}  # (method, rule) -> RouteStats
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.sampler = StackSampler(interval_ms / 1000.0, max_stacks)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule(self.path, 'request_profiler_summary', self.summary_view)
+        app.add_url_rule(self.path + '/flamegraph', 'request_profiler_flamegraph', self.flamegraph_view)
+        app.extensions['request_profiler'] = self
+
+    def before_request(self):
+        rule = request.url_rule
+        key = (request.method, rule.rule if rule is not None else '<unmatched>')
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if sampled:
+            self.sampler.start(threading.get_ident(), '%s %s' % key)
+        # One attribute on g, so finishing costs a single context lookup
+        g.profiler_request = (time.perf_counter(), key, sampled)
+
+    def after_request(self, response):
+        self.finish(response.status_code >= 500)
+        return response
+
+    def teardown_request(self, exc):
+        # Only still pending if the request raised before after_request ran
+        if 'profiler_request' in g:
+            self.finish(True)
+
+    def finish(self, failed):
+        state = g.pop('profiler_request', None)
+        if state is None:
+            return
+        started, key, sampled = state
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if sampled:
+            self.sampler.stop(threading.get_ident())
+        with self.lock:
+            stats = self.routes.get(key)
+            if stats is None:
+                stats = self.routes[key] = RouteStats()
+            stats.observe(elapsed_ms, failed)
+
+    def check_access(self):
+        """Stacks and routes reveal internals, so without a token only local clients get them"""
+        if self.token:
+            supplied = request.headers.get('X-Profiler-Token', '')
+            if not hmac.compare_digest(supplied.encode(), self.token.encode()):
+                abort(403)
+        elif not is_loopback(request.remote_addr):
+            abort(403)
+
+    def summary_view(self):
+        self.check_access()
+        with self.lock:
+            routes = {f'{method} {rule}': stats.summary() for (method, rule), stats in sorted(self.routes.items())}
+            if request.args.get('reset'):
+                self.routes = {}
+                self.started = time.time()
+        return jsonify({
+            'pid': os.getpid(),
+            'since': self.started,
+            'sample_rate': self.sample_rate,
+            'routes': routes,
+        })
+
+    def flamegraph_view(self):
+        self.check_access()
+        folded = self.sampler.folded()
+        if request.args.get('reset'):
+            self.sampler.reset()
+        return folded, 200, {'Content-Type': 'text/plain; charset=utf-8'}
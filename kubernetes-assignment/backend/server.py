@@ -1,25 +1,147 @@
 #!/usr/bin/env python3
 import json
 import asyncio
+import bisect
+import itertools
 import logging
+import logging.handlers
+import atexit
+import copy
+import math
 import os
+import queue
+import random
 import sys
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from typing import Optional
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import OP_CONT
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+import orjson
 import redis
+import redis.asyncio as aioredis
 import pymongo
 from pymongo import MongoClient
+from bson import ObjectId
+from bson.errors import InvalidId
 
-# Configure logging with more details
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    stream=sys.stdout
-)
+# Run as a script, this module is __main__ (__mp_main__ in uvicorn's spawned
+# workers). Register it as "server" too, so uvicorn's "server:app" reuses it
+# instead of executing the file a second time in every process.
+if __name__ in ("__main__", "__mp_main__"):
+    sys.modules.setdefault("server", sys.modules[__name__])
+
+# Logging settings. Records are handed to a queue and written to stdout by a
+# background thread, so a slow stdout never stalls the event loop.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # "text" or "json"
+# Per-message events are sampled: LOG_SAMPLE_RATE is the default fraction that
+# gets logged and LOG_SAMPLE_RATES overrides it per event, e.g.
+# "message=0.1,redis=0,history=1". Warnings and errors are never sampled.
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.01))
+
+def parse_sample_rates(spec: str):
+    rates = {}
+    for item in spec.split(","):
+        if "=" in item:
+            event, rate = item.split("=", 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+LOG_SAMPLE_RATES = parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES", ""))
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers that parse structured fields"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        event = getattr(record, "event", None)
+        if event:
+            entry["event"] = event
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the listener thread in this process.
+
+    The stock prepare() formats the record with a plain formatter and
+    clears exc_info, which would leave JsonFormatter nothing to render the
+    traceback from. Records never leave the process, so they only need
+    their message merged before another thread formats them.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def configure_logging():
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers = [LocalQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+def log_event(event: str, msg: str, *args, level=logging.INFO):
+    """Log a hot-path event, subject to its sample rate unless it is a warning or worse; args are formatted lazily"""
+    if level < logging.WARNING:
+        rate = LOG_SAMPLE_RATES.get(event, LOG_SAMPLE_RATE)
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            return
+    logger.log(level, msg, *args, extra={"event": event})
+
+@asynccontextmanager
+async def lifespan(app):
+    """Connect to Redis and MongoDB in the background so startup never blocks on them"""
+    logger.info("Application starting up...")
+    connectors = [asyncio.create_task(connect_redis()), asyncio.create_task(connect_mongo())]
+    if METRICS_MULTIPROCESS:
+        connectors.append(asyncio.create_task(publish_gauges()))
+    heartbeats.start()
+    yield
+    logger.info("Application shutting down...")
+    for task in connectors:
+        task.cancel()
+    if manager.listener_task:
+        manager.listener_task.cancel()
+    await presence.stop()
+    heartbeats.stop()
+    # Flush queued messages to MongoDB before the process exits
+    await message_writer.stop()
+    if METRICS_MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -30,94 +152,1123 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-# Connect to Redis (with retries for kubernetes startup)
-def get_redis_connection():
-    redis_host = os.environ.get("REDIS_HOST", "redis")
-    redis_port = int(os.environ.get("REDIS_PORT", 6379))
-    max_retries = 5
-    retry_delay = 5  # seconds
-    
-    logger.info(f"Redis configuration: Host={redis_host}, Port={redis_port}")
-    
-    for attempt in range(max_retries):
+# Prometheus metrics, served on /metrics. Observations are a few dict lookups
+# and additions, cheap enough to leave on in production. With several workers
+# each process writes its metrics under PROMETHEUS_MULTIPROC_DIR and /metrics
+# merges them, whichever worker answers the scrape; gauges are summed over
+# the live workers.
+METRICS_MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+MESSAGES_RECEIVED = Counter(
+    "chat_messages_received_total", "Chat messages received over WebSockets")
+DELIVERY_LATENCY = Histogram(
+    "chat_delivery_latency_seconds", "Time from receiving a message to sending it to the recipient",
+    ["path"], buckets=LATENCY_BUCKETS)
+REDIS_PUBLISH_SECONDS = Histogram(
+    "chat_redis_publish_seconds", "Time spent publishing a message to Redis", buckets=LATENCY_BUCKETS)
+MONGO_INSERT_SECONDS = Histogram(
+    "chat_mongo_insert_seconds", "Time spent storing one batch of messages in MongoDB", buckets=LATENCY_BUCKETS)
+MONGO_INSERT_BATCH_SIZE = Histogram(
+    "chat_mongo_insert_batch_size", "Messages per MongoDB insert_many call",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+MONGO_DROPPED_MESSAGES = Counter(
+    "chat_mongo_dropped_messages_total", "Messages given up on after MongoDB rejected them or retries ran out")
+MONGO_WRITE_QUEUE_DEPTH = Gauge(
+    "chat_mongo_write_queue_depth", "Messages waiting in the MongoDB write-behind queue",
+    multiprocess_mode="livesum")
+ACTIVE_CONNECTIONS = Gauge(
+    "chat_active_connections", "WebSocket connections open on this replica",
+    multiprocess_mode="livesum")
+FAILED_SENDS = Counter(
+    "chat_failed_sends_total", "WebSocket sends that raised", ["path"])
+HEARTBEAT_PINGS = Counter(
+    "chat_heartbeat_pings_total", "Pings sent to idle WebSocket connections")
+REAPED_CONNECTIONS = Counter(
+    "chat_reaped_connections_total", "WebSocket connections closed for not answering a ping")
+THROTTLED_MESSAGES = Counter(
+    "chat_throttled_messages_total", "Inbound frames rejected by the rate, size or room limits", ["reason"])
+PENDING_MESSAGES = Counter(
+    "chat_pending_messages_total", "Direct messages queued for offline users and later delivered",
+    ["event"])
+COALESCED_MESSAGES = Histogram(
+    "chat_coalesced_frame_messages", "Messages per coalesced outbound WebSocket frame",
+    buckets=(1, 2, 5, 10, 25, 50, 100))
+HISTORY_CACHE_REQUESTS = Counter(
+    "chat_history_cache_requests_total", "Unpaged history requests by cache tier and result",
+    ["tier", "result"])
+SEARCH_SECONDS = Histogram(
+    "chat_search_seconds", "Time spent running one message search query in MongoDB", buckets=LATENCY_BUCKETS)
+HISTORY_CACHE_ENTRIES = Gauge(
+    "chat_history_cache_users", "Users whose recent history is cached on this replica",
+    multiprocess_mode="livesum")
+HISTORY_CACHE_BYTES = Gauge(
+    "chat_history_cache_bytes", "Estimated memory held by this replica's history cache",
+    multiprocess_mode="livesum")
+
+def observe_delivery(path: str, received_at):
+    if received_at:
+        DELIVERY_LATENCY.labels(path=path).observe(time.time() - received_at)
+
+# Connection settings. Clients are created lazily by the lifespan hook so the
+# app starts serving (and answering probes) before Redis or MongoDB are up.
+REDIS_HOST = os.environ.get("REDIS_HOST", "redis")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get("REDIS_CONNECT_TIMEOUT", 2))
+MONGO_HOST = os.environ.get("MONGO_HOST", "mongodb")
+MONGO_PORT = int(os.environ.get("MONGO_PORT", 27017))
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 50))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", 5000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 2000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 2000))
+# Reconnect delays grow from RETRY_BASE_DELAY up to RETRY_MAX_DELAY seconds
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", 0.5))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 30))
+# How long a readiness probe waits for each dependency to answer
+READINESS_TIMEOUT = float(os.environ.get("READINESS_TIMEOUT", 1))
+
+# Set once the matching dependency has answered a ping
+redis_client = None
+pubsub_client = None
+messages_collection = None
+
+def backoff_delays():
+    """Exponential backoff with full jitter, so replicas don't retry in lockstep"""
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        attempt += 1
+
+def create_redis_clients():
+    # Commands share a bounded pool and wait for a free connection instead of
+    # failing when it is exhausted. The pub/sub connection blocks on reads
+    # indefinitely, so it gets its own client without a socket timeout.
+    pool = aioredis.BlockingConnectionPool(
+        host=REDIS_HOST, port=REDIS_PORT, decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_SOCKET_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT, socket_connect_timeout=REDIS_CONNECT_TIMEOUT)
+    client = aioredis.Redis(connection_pool=pool)
+    subscriber = aioredis.Redis(
+        host=REDIS_HOST, port=REDIS_PORT, decode_responses=True,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT, socket_keepalive=True)
+    return client, subscriber
+
+async def connect_redis():
+    """Wait for Redis to answer, then start the pub/sub listener"""
+    global redis_client, pubsub_client
+    logger.info("Redis configuration: Host=%s, Port=%s", REDIS_HOST, REDIS_PORT)
+    client, subscriber = create_redis_clients()
+    for attempt, delay in enumerate(backoff_delays(), 1):
         try:
-            logger.info(f"Connecting to Redis at {redis_host}:{redis_port} (attempt {attempt+1}/{max_retries})")
-            r = redis.Redis(host=redis_host, port=redis_port, decode_responses=True)
-            r.ping()  # Test connection
-            logger.info("Successfully connected to Redis")
-            return r
-        except redis.ConnectionError as e:
-            if attempt < max_retries - 1:
-                logger.warning(f"Failed to connect to Redis: {e}. Retrying in {retry_delay} seconds...")
-                import time
-                time.sleep(retry_delay)
-            else:
-                logger.error(f"Failed to connect to Redis after {max_retries} attempts: {e}")
-                raise
-
-# Connect to MongoDB (with retries for kubernetes startup)
-def get_mongo_connection():
-    mongo_host = os.environ.get("MONGO_HOST", "mongodb")
-    mongo_port = int(os.environ.get("MONGO_PORT", 27017))
-    max_retries = 5
-    retry_delay = 5  # seconds
-    
-    for attempt in range(max_retries):
+            await client.ping()
+            break
+        except redis.RedisError as e:
+            logger.warning("Redis not reachable (attempt %s): %s. Retrying in %.1f seconds...", attempt, e, delay)
+            await asyncio.sleep(delay)
+    redis_client, pubsub_client = client, subscriber
+    logger.info("Successfully connected to Redis")
+    await manager.start_redis_listener()
+    await presence.start()
+
+async def connect_mongo():
+    """Wait for MongoDB to answer, start the writer, then create indexes"""
+    global messages_collection
+    logger.info("MongoDB configuration: Host=%s, Port=%s", MONGO_HOST, MONGO_PORT)
+    # MongoClient connects in the background; pymongo reconnects on its own
+    # after this, so only the first successful ping needs waiting for
+    client = MongoClient(
+        f"mongodb://{MONGO_HOST}:{MONGO_PORT}/",
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS)
+    for attempt, delay in enumerate(backoff_delays(), 1):
         try:
-            logger.info(f"Connecting to MongoDB at {mongo_host}:{mongo_port} (attempt {attempt+1}/{max_retries})")
-            client = MongoClient(f"mongodb://{mongo_host}:{mongo_port}/")
-            # Test connection
-            client.admin.command('ismaster')
-            db = client.chat_app
-            messages_collection = db.messages
-            logger.info("Successfully connected to MongoDB")
-            return messages_collection
-        except pymongo.errors.ConnectionFailure as e:
-            if attempt < max_retries - 1:
-                logger.warning(f"Failed to connect to MongoDB: {e}. Retrying in {retry_delay} seconds...")
-                import time
-                time.sleep(retry_delay)
-            else:
-                logger.error(f"Failed to connect to MongoDB after {max_retries} attempts: {e}")
-                raise
-
-# Initialize Redis and MongoDB connections with proper error handling
-try:
-    redis_client = get_redis_connection()
-    messages_collection = get_mongo_connection()
-except Exception as e:
-    logger.error(f"Failed to initialize connections: {e}")
-    redis_client = None
-    messages_collection = None
+            await asyncio.to_thread(client.admin.command, 'ping')
+            break
+        except pymongo.errors.PyMongoError as e:
+            logger.warning("MongoDB not reachable (attempt %s): %s. Retrying in %.1f seconds...", attempt, e, delay)
+            await asyncio.sleep(delay)
+    # The writer must be running before the collection is published, or
+    # publish_message would hand it messages it drops
+    await message_writer.start()
+    messages_collection = client.chat_app.messages
+    logger.info("Successfully connected to MongoDB")
+    # Index builds can take a while on a large collection; writes and
+    # readiness don't wait for them (queries only run slower meanwhile)
+    try:
+        await asyncio.to_thread(ensure_message_indexes, messages_collection)
+    except Exception as e:
+        logger.error("Failed to create MongoDB indexes: %s", e)
+
+async def redis_ready():
+    if redis_client is None or manager.pubsub is None:
+        return False
+    try:
+        return await asyncio.wait_for(redis_client.ping(), READINESS_TIMEOUT)
+    except (redis.RedisError, asyncio.TimeoutError):
+        return False
+
+async def mongo_ready():
+    if messages_collection is None:
+        return False
+    try:
+        await asyncio.wait_for(
+            asyncio.to_thread(messages_collection.database.client.admin.command, 'ping'),
+            READINESS_TIMEOUT)
+        return True
+    except (pymongo.errors.PyMongoError, asyncio.TimeoutError):
+        return False
+
+# Compound indexes backing the history query: each branch of the from/to $or
+# is an index range scan and the branches are merge-sorted on (timestamp, _id)
+MESSAGE_INDEXES = [
+    ([("from", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], "from_timestamp_id"),
+    ([("to", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], "to_timestamp_id"),
+]
+
+# Full-text index for message search. MongoDB allows one text index per
+# collection; SEARCH_LANGUAGE picks its stemming and stop words ("none"
+# matches whole words only).
+SEARCH_LANGUAGE = os.environ.get("SEARCH_LANGUAGE", "english")
+
+def ensure_message_indexes(collection):
+    for keys, name in MESSAGE_INDEXES:
+        collection.create_index(keys, name=name)
+    collection.create_index([("text", pymongo.TEXT)], name="text", default_language=SEARCH_LANGUAGE)
+    logger.info("MongoDB message indexes are in place")
+
+class MessageWriter:
+    """Write-behind buffer that persists chat messages to MongoDB in batches.
+
+    Handlers only pay for an in-memory enqueue; a background task drains the
+    queue and calls insert_many in a worker thread once either the batch size
+    or the flush interval is reached. The queue is bounded, so when MongoDB
+    falls behind the senders wait instead of memory growing without limit.
+    """
+
+    _STOP = object()
+
+    def __init__(self):
+        self.max_queue_size = int(os.environ.get("MONGO_WRITE_QUEUE_SIZE", 10000))
+        self.batch_size = int(os.environ.get("MONGO_WRITE_BATCH_SIZE", 500))
+        self.flush_interval = float(os.environ.get("MONGO_WRITE_FLUSH_INTERVAL", 0.05))  # seconds
+        # Retries of a batch that hit a connection error, backing off like reconnects
+        self.max_retries = int(os.environ.get("MONGO_WRITE_RETRIES", 8))
+        self.queue = None
+        self.writer_task = None
+        # Messages accepted and messages written (or given up on), for wait_flushed()
+        self.enqueued = 0
+        self.flushed = 0
+        self.flushed_changed = None
+
+    async def start(self):
+        """Create the queue and start the background writer"""
+        if self.writer_task:
+            return
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.flushed_changed = asyncio.Condition()
+        self.writer_task = asyncio.create_task(self.writer())
+        logger.info("MongoDB writer started (batch size %s, flush interval %ss)", self.batch_size, self.flush_interval)
+
+    async def enqueue(self, record):
+        """Queue a message for persistence, waiting if the queue is full"""
+        if not self.writer_task:
+            logger.error("MongoDB writer not started, dropping message")
+            return False
+        await self.queue.put(record)
+        self.enqueued += 1
+        return True
+
+    async def wait_flushed(self):
+        """Wait until every message enqueued so far has been through insert_many"""
+        if not self.writer_task:
+            return
+        target = self.enqueued
+        async with self.flushed_changed:
+            await self.flushed_changed.wait_for(lambda: self.flushed >= target)
+
+    async def stop(self):
+        """Flush everything still queued and stop the writer"""
+        if not self.writer_task:
+            return
+        await self.queue.put(self._STOP)
+        await self.writer_task
+        self.writer_task = None
+        logger.info("MongoDB writer stopped")
+
+    async def writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            record = await self.queue.get()
+            if record is self._STOP:
+                return
+            batch = [record]
+            stopping = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        record = await asyncio.wait_for(self.queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if record is self._STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+            await self.flush(batch)
+            if stopping:
+                return
+
+    async def flush(self, batch):
+        """Store a batch, retrying connection errors with backoff.
+
+        The writer does not take more records off the queue while it retries,
+        so a MongoDB outage fills the queue and senders wait, as they do when
+        MongoDB is merely slow. Every record carries its _id, so a record that
+        reached MongoDB before the connection broke fails the retry with a
+        duplicate key error, which counts as stored.
+        """
+        MONGO_INSERT_BATCH_SIZE.observe(len(batch))
+        total = len(batch)
+        delays = backoff_delays()
+        for attempt in range(1, self.max_retries + 2):
+            try:
+                with MONGO_INSERT_SECONDS.time():
+                    await asyncio.to_thread(messages_collection.insert_many, batch, ordered=False)
+                logger.debug("Stored %s messages in MongoDB", len(batch))
+                batch = []
+                break
+            except pymongo.errors.BulkWriteError as e:
+                # Write errors other than duplicates won't go away on a retry
+                failed = [error for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+                if failed:
+                    MONGO_DROPPED_MESSAGES.inc(len(failed))
+                    logger.error("MongoDB rejected %s of %s messages: %s", len(failed), len(batch), failed[0].get("errmsg"))
+                batch = []
+                break
+            except pymongo.errors.ConnectionFailure as e:
+                if attempt > self.max_retries:
+                    break
+                delay = next(delays)
+                logger.warning("Failed to store %s messages in MongoDB (attempt %s): %s. Retrying in %.1f seconds...",
+                               len(batch), attempt, e, delay)
+                await asyncio.sleep(delay)
+            except Exception as e:
+                logger.error("Failed to store %s messages in MongoDB: %s", len(batch), e)
+                break
+        if batch:
+            MONGO_DROPPED_MESSAGES.inc(len(batch))
+            logger.error("Dropped %s messages that could not be stored in MongoDB", len(batch))
+        async with self.flushed_changed:
+            self.flushed += total
+            self.flushed_changed.notify_all()
+
+
+# Recent history cache. The newest HISTORY_CACHE_MESSAGES messages of up to
+# HISTORY_CACHE_USERS users are kept in an in-process LRU that also evicts
+# once its rows add up to HISTORY_CACHE_MAX_BYTES (per worker), so the unpaged
+# history request a client makes on every page load and reconnect is served
+# without MongoDB. Messages are added as they are published or relayed to
+# this replica; entries expire after HISTORY_CACHE_TTL seconds, which bounds
+# how stale a replica that saw neither side of a conversation can get. With
+# HISTORY_CACHE_REDIS enabled, replicas also share a copy in Redis that every
+# publishing replica adds to, so a user's first load on another replica
+# skips MongoDB as well.
+HISTORY_CACHE_USERS = int(os.environ.get("HISTORY_CACHE_USERS", 10000))
+HISTORY_CACHE_MESSAGES = int(os.environ.get("HISTORY_CACHE_MESSAGES", 100))
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get("HISTORY_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+HISTORY_CACHE_TTL = float(os.environ.get("HISTORY_CACHE_TTL", 60))
+HISTORY_CACHE_REDIS = os.environ.get("HISTORY_CACHE_REDIS", "false").lower() in ("1", "true", "yes")
+HISTORY_CACHE_REDIS_TTL = int(os.environ.get("HISTORY_CACHE_REDIS_TTL", 3600))
+# How long a miss waits for this replica's write-behind queue to reach
+# MongoDB; a page served without that is returned but not cached
+HISTORY_FLUSH_WAIT = float(os.environ.get("HISTORY_FLUSH_WAIT", 1))
+HISTORY_KEY_PREFIX = "chat:recent:"
+HISTORY_LOADED_PREFIX = "chat:recent-loaded:"
+
+def history_key(user_id: str):
+    return f"{HISTORY_KEY_PREFIX}{user_id}"
+
+def history_loaded_key(user_id: str):
+    return f"{HISTORY_LOADED_PREFIX}{user_id}"
+
+# Measured cost of one cached row besides its text and timestamp: the row
+# dict, its sort key and ID string, and the list slots pointing at them
+HISTORY_ROW_OVERHEAD = 440
+
+def history_item(timestamp, message_id, row):
+    """A message as stored in the shared copy; it must start with its sort key"""
+    return orjson.dumps([timestamp, message_id, row['from'], row.get('to'), row['text']])
+
+def history_row_size(row):
+    return HISTORY_ROW_OVERHEAD + sys.getsizeof(row['text']) + sys.getsizeof(row['timestamp'])
+
+
+class HistoryEntry:
+    """The newest messages of one user, oldest first, next to their (timestamp, id) sort keys"""
+
+    __slots__ = ('keys', 'rows', 'has_more', 'expires', 'size')
+
+    def __init__(self, keys, rows, has_more):
+        self.keys = keys
+        self.rows = rows
+        self.has_more = has_more
+        self.expires = time.monotonic() + HISTORY_CACHE_TTL
+        self.size = sum(map(history_row_size, rows))
+
+    def add(self, key, row):
+        """Insert a message in history order, ignoring one that is already there"""
+        index = bisect.bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            return
+        self.keys.insert(index, key)
+        self.rows.insert(index, row)
+        self.size += history_row_size(row)
+
+    def trim(self):
+        excess = len(self.rows) - HISTORY_CACHE_MESSAGES
+        if excess > 0:
+            self.size -= sum(map(history_row_size, self.rows[:excess]))
+            del self.keys[:excess]
+            del self.rows[:excess]
+            self.has_more = True
+
+    def covers(self, limit: int):
+        return limit <= len(self.rows) or not self.has_more
+
+    def page(self, limit: int):
+        """(rows, first key, last key, has_more) for the newest `limit` messages"""
+        keys = self.keys[-limit:]
+        if not keys:
+            return [], None, None, self.has_more
+        return self.rows[-limit:], keys[0], keys[-1], self.has_more or len(self.rows) > limit
+
+
+class HistoryCache:
+    """Read-through cache of each user's most recent messages.
+
+    read() answers from memory, then from the shared Redis copy, and only
+    then queries MongoDB. A user being loaded is listed in `filling`, and
+    messages recorded meanwhile are merged into the result, so a write that
+    races the load is never lost.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()  # user ID -> HistoryEntry, least recently used first
+        self.filling = {}  # user ID -> [(key, row), ...] recorded while loading
+        self.size = 0  # estimated bytes held by all entries
+
+    @property
+    def enabled(self):
+        return HISTORY_CACHE_USERS > 0 and HISTORY_CACHE_MESSAGES > 0 and HISTORY_CACHE_MAX_BYTES > 0
+
+    def tracks(self, user_id):
+        return user_id in self.entries or user_id in self.filling
+
+    def lookup(self, user_id: str):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        if entry.expires <= time.monotonic():
+            self.discard(user_id)
+            return None
+        self.entries.move_to_end(user_id)
+        return entry
+
+    def store(self, user_id: str, entry: HistoryEntry):
+        self.discard(user_id)
+        self.entries[user_id] = entry
+        self.size += entry.size
+        while self.entries and (len(self.entries) > HISTORY_CACHE_USERS or self.size > HISTORY_CACHE_MAX_BYTES):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def discard(self, user_id: str):
+        entry = self.entries.pop(user_id, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    async def read(self, user_id: str, limit: int):
+        """The newest `limit` messages of user_id, as HistoryEntry.page() returns them"""
+        entry = self.lookup(user_id)
+        if entry is not None and entry.covers(limit):
+            HISTORY_CACHE_REQUESTS.labels(tier="local", result="hit").inc()
+            return entry.page(limit)
+        HISTORY_CACHE_REQUESTS.labels(tier="local", result="miss").inc()
+        if user_id in self.filling:
+            # Another request is already loading this user; don't race it
+            rows, has_more = await asyncio.to_thread(query_message_history, user_id, limit)
+            return self.from_rows(rows, has_more).page(limit)
+
+        self.filling[user_id] = recorded = []
+        try:
+            entry, recent = await self.load_shared(user_id) if HISTORY_CACHE_REDIS else (None, [])
+            if entry is not None and not entry.covers(limit):
+                recent = list(zip(entry.keys, entry.rows))
+                entry = None
+            if HISTORY_CACHE_REDIS:
+                HISTORY_CACHE_REQUESTS.labels(tier="redis", result="miss" if entry is None else "hit").inc()
+            shared = entry is not None
+            complete = True
+            if entry is None:
+                # The write-behind queue may still hold messages the query should
+                # see; other replicas' queues are covered by `recent`. While
+                # MongoDB is failing over the writer retries for minutes, so
+                # don't hold the request up for all of that.
+                try:
+                    await asyncio.wait_for(message_writer.wait_flushed(), HISTORY_FLUSH_WAIT)
+                except asyncio.TimeoutError:
+                    complete = False
+                    log_event("history", "Write-behind queue not flushed within %ss; not caching history of %s",
+                              HISTORY_FLUSH_WAIT, user_id, level=logging.WARNING)
+                rows, has_more = await asyncio.to_thread(
+                    query_message_history, user_id, max(limit, HISTORY_CACHE_MESSAGES))
+                entry = self.from_rows(rows, has_more)
+            for key, row in itertools.chain(recent, recorded):
+                entry.add(key, row)
+            page = entry.page(limit)
+            # Timestamps come from clients; only string ones sort consistently
+            if complete and all(isinstance(key[0], str) for key in entry.keys):
+                entry.trim()
+                self.store(user_id, entry)
+                if not shared:
+                    await self.save_shared(user_id, entry)
+            return page
+        finally:
+            del self.filling[user_id]
+
+    @staticmethod
+    def from_rows(rows, has_more):
+        keys = [(row['timestamp'], str(row.pop('_id'))) for row in rows]
+        return HistoryEntry(keys, rows, has_more)
+
+    def remember(self, envelope):
+        """Add a message to the cached history of its sender and recipient on this replica"""
+        key = (envelope['timestamp'], envelope['id'])
+        row = {
+            'from': envelope['from'],
+            'to': envelope.get('to'),
+            'text': envelope['text'],
+            'timestamp': envelope['timestamp']
+        }
+        for user_id in {envelope['from'], envelope.get('to')}:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                if isinstance(key[0], str):
+                    self.size -= entry.size
+                    entry.add(key, row)
+                    entry.trim()
+                    self.size += entry.size
+                else:
+                    self.discard(user_id)
+            recorded = self.filling.get(user_id)
+            if recorded is not None:
+                recorded.append((key, row))
+
+    async def record(self, envelope):
+        """Add a message published by this replica to the local and shared caches"""
+        self.remember(envelope)
+        if not HISTORY_CACHE_REDIS or redis_client is None:
+            return
+        try:
+            # Added whether or not the copy was loaded, so a replica loading it
+            # from MongoDB meanwhile merges around this message instead of
+            # missing it while it waits in our write-behind queue
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for user_id in {envelope['from'], envelope.get('to')} - {None}:
+                    if isinstance(envelope['timestamp'], str):
+                        self.add_shared(pipe, user_id, [history_item(
+                            envelope['timestamp'], envelope['id'], envelope)])
+                    else:
+                        pipe.delete(history_key(user_id), history_loaded_key(user_id))
+                await pipe.execute()
+        except Exception as e:
+            logger.error("Failed to update shared history cache: %s", e)
+
+    @staticmethod
+    def add_shared(pipe, user_id: str, items):
+        """Queue a merge of items into user_id's shared copy, keeping the newest HISTORY_CACHE_MESSAGES"""
+        key = history_key(user_id)
+        # Equal scores order members by their bytes, which start with the
+        # timestamp and ID, so rank order is history order
+        pipe.zadd(key, dict.fromkeys(items, 0))
+        pipe.zremrangebyrank(key, 0, -HISTORY_CACHE_MESSAGES - 1)
+        pipe.expire(key, HISTORY_CACHE_REDIS_TTL)
+
+    async def load_shared(self, user_id: str):
+        """(entry, []) from a fully loaded shared copy, or (None, [(key, row), ...])
+        with whatever publishers added to a copy that was never loaded"""
+        if redis_client is None:
+            return None, []
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.exists(history_loaded_key(user_id))
+                pipe.zrange(history_key(user_id), 0, -1)
+                loaded, items = await pipe.execute()
+        except Exception as e:
+            logger.error("Failed to read shared history cache for %s: %s", user_id, e)
+            return None, []
+        keys, rows = [], []
+        for timestamp, message_id, from_user, to_user, text in sorted(map(orjson.loads, items)):
+            keys.append((timestamp, message_id))
+            rows.append({'from': from_user, 'to': to_user, 'text': text, 'timestamp': timestamp})
+        # Without the marker the copy only holds what was published since it
+        # was last loaded, not the history before that
+        if not loaded or not rows:
+            return None, list(zip(keys, rows))
+        # A full copy may have had older messages trimmed off
+        return HistoryEntry(keys, rows, len(rows) >= HISTORY_CACHE_MESSAGES), []
+
+    async def save_shared(self, user_id: str, entry: HistoryEntry):
+        if not HISTORY_CACHE_REDIS or redis_client is None or not entry.rows:
+            return
+        items = [history_item(timestamp, message_id, row)
+                 for (timestamp, message_id), row in zip(entry.keys, entry.rows)]
+        try:
+            # Merge rather than overwrite, so messages other replicas added
+            # while this one queried MongoDB are kept. The marker never
+            # outlives the copy, since publishers only extend the copy's TTL.
+            async with redis_client.pipeline(transaction=True) as pipe:
+                self.add_shared(pipe, user_id, items)
+                pipe.set(history_loaded_key(user_id), 1, ex=HISTORY_CACHE_REDIS_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logger.error("Failed to write shared history cache for %s: %s", user_id, e)
+
+
+# Redis channels. Each replica subscribes to its own replica channel, which
+# carries direct messages for the users it hosts, to the channels of the rooms
+# its users are in, to the watch channels of the users its users want
+# presence notices about, and to the low-traffic system channel.
+SYSTEM_CHANNEL = "chat:system"
+REPLICA_CHANNEL_PREFIX = "chat:replica:"
+ROOM_CHANNEL_PREFIX = "chat:room:"
+WATCH_CHANNEL_PREFIX = "chat:watch:"
+
+def replica_channel(replica_id: str):
+    return f"{REPLICA_CHANNEL_PREFIX}{replica_id}"
+
+def room_channel(room: str):
+    return f"{ROOM_CHANNEL_PREFIX}{room}"
+
+# Every room a replica's users are in costs a subscription on the shared
+# pub/sub connection, so each user may be in at most MAX_ROOMS_PER_USER rooms
+# with names of up to MAX_ROOM_NAME_LENGTH characters
+MAX_ROOMS_PER_USER = int(os.environ.get("MAX_ROOMS_PER_USER", 50))
+MAX_ROOM_NAME_LENGTH = int(os.environ.get("MAX_ROOM_NAME_LENGTH", 64))
+
+def valid_room(room):
+    return isinstance(room, str) and 0 < len(room) <= MAX_ROOM_NAME_LENGTH
+
+def room_error(text: str):
+    return orjson.dumps({
+        "type": "error",
+        "from": "system",
+        "text": text,
+        "max_rooms": MAX_ROOMS_PER_USER,
+        "max_room_length": MAX_ROOM_NAME_LENGTH,
+        "timestamp": datetime.now().isoformat()
+    }).decode()
+
+async def enter_room(websocket: WebSocket, user_id: str, room):
+    """Join a room a client asked for, telling the client if it may not; returns whether it joined"""
+    if not valid_room(room):
+        reason, text = "bad_room", f"Room names must be strings of at most {MAX_ROOM_NAME_LENGTH} characters."
+    elif await manager.join_room(user_id, room):
+        return True
+    else:
+        reason, text = "room_limit", f"You can be in at most {MAX_ROOMS_PER_USER} rooms; leave one first."
+    THROTTLED_MESSAGES.labels(reason=reason).inc()
+    log_event("message", "Refused room %r for %s: %s", room, user_id, reason, level=logging.WARNING)
+    await websocket.send_text(room_error(text))
+    return False
+
+def watch_channel(user_id: str):
+    return f"{WATCH_CHANNEL_PREFIX}{user_id}"
+
+# Presence notices only go to users who watch someone: their direct-message
+# contacts, and anyone they name in a {"type": "watch"} frame, up to
+# MAX_WATCHED_USERS each
+MAX_WATCHED_USERS = int(os.environ.get("MAX_WATCHED_USERS", 100))
+
+# Direct messages for users who are connected nowhere wait in a capped Redis
+# list until they reconnect. Untouched lists expire after PENDING_TTL seconds.
+PENDING_KEY_PREFIX = "chat:pending:"
+PENDING_MAX_MESSAGES = int(os.environ.get("PENDING_MAX_MESSAGES", 100))
+PENDING_TTL = int(os.environ.get("PENDING_TTL", 7 * 24 * 3600))
+
+def pending_key(user_id: str):
+    return f"{PENDING_KEY_PREFIX}{user_id}"
+
+# A chat message is turned into one canonical JSON envelope, serialized once
+# with orjson, and that exact string is what every recipient socket is sent.
+# On Redis it travels behind a one-line routing header, so listeners never
+# decode or re-encode the envelope itself. orjson escapes newlines inside
+# strings, so the first newline always ends the header. The envelope ID is
+# the message's MongoDB _id, so any replica can place it in cached history.
+REPLICA_ID = uuid.uuid4().hex[:12]
+
+def build_envelope(message_data):
+    envelope = {
+        'id': str(ObjectId()),
+        'from': message_data['from'],
+        'text': message_data.get('text'),
+        'timestamp': message_data.get('timestamp') or datetime.now().isoformat()
+    }
+    if message_data.get('room'):
+        envelope['room'] = message_data['room']
+    else:
+        envelope['to'] = message_data.get('to')
+    return envelope
+
+def encode_relay(envelope_text: str, sender: str, received_at, recipient: Optional[str] = None):
+    return orjson.dumps([REPLICA_ID, sender, received_at, recipient]).decode() + "\n" + envelope_text
+
+def decode_relay(data: str):
+    """Split a relayed message into (origin replica, sender, received_at, recipient, envelope text)"""
+    header, _, envelope_text = data.partition("\n")
+    origin, sender, received_at, recipient = orjson.loads(header)
+    return origin, sender, received_at, recipient, envelope_text
+
+# Cluster-wide presence. Each connected user has a hash of the replicas that
+# host one of their sessions, each with its own expiry time, so routing a
+# direct message is one HGETALL, and a sorted set scored by expiry time lists
+# everyone online. Both are refreshed by every hosting replica's heartbeat; a
+# replica's entries lapse PRESENCE_TTL seconds after it stops.
+PRESENCE_KEY_PREFIX = "chat:replicas:"
+ONLINE_USERS_KEY = "chat:online"
+PRESENCE_HEARTBEAT = float(os.environ.get("PRESENCE_HEARTBEAT", 10))
+PRESENCE_TTL = int(os.environ.get("PRESENCE_TTL", 30))
+
+def presence_key(user_id: str):
+    return f"{PRESENCE_KEY_PREFIX}{user_id}"
+
+# Both scripts drop entries of replicas that stopped refreshing and return
+# how many other replicas still host the user, so only the cluster-wide
+# first and last session announce the user
+JOIN_PRESENCE_SCRIPT = """
+local others = 0
+local hosts = redis.call('hgetall', KEYS[1])
+for i = 1, #hosts, 2 do
+    if tonumber(hosts[i + 1]) <= tonumber(ARGV[2]) then
+        redis.call('hdel', KEYS[1], hosts[i])
+    elseif hosts[i] ~= ARGV[1] then
+        others = others + 1
+    end
+end
+redis.call('hset', KEYS[1], ARGV[1], ARGV[3])
+redis.call('expire', KEYS[1], ARGV[4])
+redis.call('zadd', KEYS[2], ARGV[3], ARGV[5])
+return others
+"""
+
+# Only this replica's entry is released; the user stays online while another
+# replica still hosts them
+LEAVE_PRESENCE_SCRIPT = """
+redis.call('hdel', KEYS[1], ARGV[1])
+local others = 0
+local hosts = redis.call('hgetall', KEYS[1])
+for i = 1, #hosts, 2 do
+    if tonumber(hosts[i + 1]) > tonumber(ARGV[2]) then
+        others = others + 1
+    end
+end
+if others == 0 then
+    redis.call('del', KEYS[1])
+    redis.call('zrem', KEYS[2], ARGV[3])
+end
+return others
+"""
+
+
+class PresenceRegistry:
+    """Records which replicas each connected user is on, in Redis.
+
+    join() and leave() are called for a user's first and last session on
+    this replica, and a heartbeat task re-registers all local users every
+    PRESENCE_HEARTBEAT seconds. Entries of a replica that dies expire on
+    their own.
+    """
+
+    def __init__(self):
+        self.heartbeat_task = None
+        self.join_script = None
+        self.leave_script = None
+
+    async def start(self):
+        self.join_script = redis_client.register_script(JOIN_PRESENCE_SCRIPT)
+        self.leave_script = redis_client.register_script(LEAVE_PRESENCE_SCRIPT)
+        # Users who connected while Redis was away
+        await self.register(*manager.active_connections)
+        if self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
+
+    async def stop(self):
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+
+    async def register(self, *user_ids):
+        """Refresh this replica's entries for the given users"""
+        if redis_client is None or not user_ids:
+            return
+        expires = time.time() + PRESENCE_TTL
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for user_id in user_ids:
+                    pipe.hset(presence_key(user_id), REPLICA_ID, expires)
+                    pipe.expire(presence_key(user_id), PRESENCE_TTL)
+                pipe.zadd(ONLINE_USERS_KEY, {user_id: expires for user_id in user_ids})
+                await pipe.execute()
+        except Exception as e:
+            logger.error("Failed to register presence for %s users: %s", len(user_ids), e)
+
+    async def join(self, user_id: str):
+        """Register a user's first session here; returns True if no other replica hosts them"""
+        if self.join_script is None:
+            return True
+        now = time.time()
+        try:
+            others = await self.join_script(
+                keys=[presence_key(user_id), ONLINE_USERS_KEY],
+                args=[REPLICA_ID, now, now + PRESENCE_TTL, PRESENCE_TTL, user_id])
+            return others == 0
+        except Exception as e:
+            logger.error("Failed to register presence for %s: %s", user_id, e)
+            return True
+
+    async def leave(self, user_id: str):
+        """Release this replica's entry; returns True if no other replica hosts the user"""
+        if self.leave_script is None:
+            return True
+        try:
+            others = await self.leave_script(
+                keys=[presence_key(user_id), ONLINE_USERS_KEY], args=[REPLICA_ID, time.time(), user_id])
+            return others == 0
+        except Exception as e:
+            logger.error("Failed to unregister presence for %s: %s", user_id, e)
+            return True
+
+    async def locate(self, user_id: str):
+        """IDs of the replicas hosting user_id, including this one; empty if they are offline"""
+        if redis_client is None:
+            return []
+        try:
+            hosts = await redis_client.hgetall(presence_key(user_id))
+        except Exception as e:
+            logger.error("Failed to look up presence for %s: %s", user_id, e)
+            return []
+        now = time.time()
+        return [replica_id for replica_id, expires in hosts.items() if float(expires) > now]
+
+    async def online_users(self):
+        return await redis_client.zrangebyscore(ONLINE_USERS_KEY, time.time(), "+inf")
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT)
+            await self.register(*manager.active_connections)
+            try:
+                # Forget users whose replicas stopped refreshing them
+                await redis_client.zremrangebyscore(ONLINE_USERS_KEY, "-inf", time.time())
+            except Exception as e:
+                logger.error("Failed to prune expired presence entries: %s", e)
+
+# Inbound limits. Each user may send RATE_LIMIT_PER_SECOND frames per second
+# on average and RATE_LIMIT_BURST in a burst, over all of their connections
+# to this replica (0 disables the rate limit). Frames over MAX_MESSAGE_BYTES are answered with an error; frames
+# over MAX_FRAME_BYTES are refused by the server before they are buffered.
+RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", 10))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 20))
+MAX_MESSAGE_BYTES = int(os.environ.get("MAX_MESSAGE_BYTES", 4096))
+MAX_FRAME_BYTES = int(os.environ.get("MAX_FRAME_BYTES", 1024 * 1024))
+
+
+def message_too_large(data: str):
+    # A str never has more characters than its UTF-8 encoding has bytes
+    if len(data) > MAX_MESSAGE_BYTES:
+        return True
+    return not data.isascii() and len(data.encode()) > MAX_MESSAGE_BYTES
+
+# Outbound frames. permessage-deflate is negotiated with clients that offer
+# it (WS_COMPRESSION), but frames under WS_COMPRESSION_THRESHOLD bytes are
+# sent uncompressed, since deflate only costs CPU on a short envelope. With
+# WS_COALESCE_WINDOW above 0, chat messages for a connection are held for up
+# to that many seconds (or WS_COALESCE_MAX_MESSAGES messages) and sent as one
+# JSON array frame; a lone message is still sent as a plain envelope.
+WS_COMPRESSION = os.environ.get("WS_COMPRESSION", "true").lower() in ("1", "true", "yes")
+WS_COMPRESSION_THRESHOLD = int(os.environ.get("WS_COMPRESSION_THRESHOLD", 256))
+WS_COALESCE_WINDOW = float(os.environ.get("WS_COALESCE_WINDOW", 0))
+WS_COALESCE_MAX_MESSAGES = int(os.environ.get("WS_COALESCE_MAX_MESSAGES", 100))
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    def encode(self, frame):
+        # RFC 7692 lets a sender leave any message uncompressed (RSV1 unset)
+        if frame.fin and frame.opcode is not OP_CONT and len(frame.data) < WS_COMPRESSION_THRESHOLD:
+            return frame
+        return super().encode(frame)
+
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover, extension.local_no_context_takeover,
+            extension.remote_max_window_bits, extension.local_max_window_bits, extension.compress_settings)
+
+
+class ChatWebSocketProtocol(WebSocketProtocol):
+    """uvicorn's websockets protocol, negotiating the thresholded deflate extension"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.config.ws_per_message_deflate:
+            self.available_extensions = [ThresholdDeflateFactory()]
+
+class TokenBucket:
+    """A user's rate limit, shared by all of their sessions on this replica"""
+
+    __slots__ = ("tokens", "updated", "throttled")
+
+    def __init__(self):
+        self.tokens = RATE_LIMIT_BURST
+        self.updated = time.monotonic()
+        self.throttled = False
+
+    def take(self):
+        """Spend a token; returns 0 if the frame may go through, else seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(RATE_LIMIT_BURST, self.tokens + (now - self.updated) * RATE_LIMIT_PER_SECOND)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / RATE_LIMIT_PER_SECOND
+
+    def full_at(self):
+        """When the bucket is full again, and so no different from a new one"""
+        return self.updated + (RATE_LIMIT_BURST - self.tokens) / RATE_LIMIT_PER_SECOND
+
+# A user may be connected from up to MAX_SESSIONS_PER_USER devices at once;
+# connecting one more closes their oldest connection
+MAX_SESSIONS_PER_USER = int(os.environ.get("MAX_SESSIONS_PER_USER", 5))
+session_ids = itertools.count()
+
+
+class Session:
+    """One WebSocket connection: a user on one device.
+
+    Everything the backend tracks per connection lives here, along with the
+    user's shared token bucket, so a lookup or teardown touches one object
+    instead of a set of parallel dicts. The fixed __slots__ layout keeps each
+    session small.
+    """
+    __slots__ = ("user_id", "device", "websocket", "connected_at", "last_seen", "pinged_at", "slot",
+                 "bucket", "messages_in", "messages_out", "active", "outbox")
+
+    def __init__(self, user_id: str, device, websocket: WebSocket):
+        self.user_id = user_id
+        self.device = device
+        self.websocket = websocket
+        self.connected_at = self.last_seen = time.time()
+        self.pinged_at = None  # time of the unanswered heartbeat ping
+        self.slot = None       # heartbeat wheel slot
+        self.bucket = None     # set by ConnectionManager.register
+        self.messages_in = 0
+        self.messages_out = 0
+        self.active = True
+        self.outbox = None  # [(envelope text, received_at), ...] waiting for a coalesced send
+
+
+# Server-side heartbeat. A connection that has sent nothing for
+# HEARTBEAT_INTERVAL seconds is pinged, and closed if it still sends nothing
+# within HEARTBEAT_TIMEOUT seconds. Deadlines are kept to HEARTBEAT_TICK.
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", 30))
+HEARTBEAT_TIMEOUT = float(os.environ.get("HEARTBEAT_TIMEOUT", 10))
+HEARTBEAT_TICK = float(os.environ.get("HEARTBEAT_TICK", 1))
+
+
+class HeartbeatScheduler:
+    """Pings idle WebSocket connections and reaps the ones that don't answer.
+
+    Every local session sits in exactly one slot of a timer wheel, so a
+    single task checks only the sessions that are due on each tick, and
+    memory stays proportional to the number of connections. Inbound frames
+    just stamp session.last_seen; the wheel reads it when the slot comes up.
+    Checks run as their own tasks, so a socket whose send hangs holds up
+    only itself, and the cursor follows the clock rather than counting
+    loop iterations.
+    """
+
+    def __init__(self):
+        self.slots = [set() for _ in range(int(max(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT) / HEARTBEAT_TICK) + 2)]
+        self.cursor = 0
+        self.task = None
+        self.checks = set()  # running check tasks
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        for check in self.checks:
+            check.cancel()
+
+    def schedule(self, session: Session, delay: float):
+        if session.slot is not None:
+            self.slots[session.slot].discard(session)
+        ticks = min(len(self.slots) - 1, max(1, int(-(-delay // HEARTBEAT_TICK))))
+        session.slot = (self.cursor + ticks) % len(self.slots)
+        self.slots[session.slot].add(session)
+
+    def track(self, session: Session):
+        session.pinged_at = None
+        self.schedule(session, HEARTBEAT_INTERVAL)
+
+    def forget(self, session: Session):
+        if session.slot is not None:
+            self.slots[session.slot].discard(session)
+            session.slot = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += HEARTBEAT_TICK
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            # Every tick that has passed is due, even if this task woke late;
+            # past a whole turn of the wheel each slot only needs visiting once
+            behind = int((loop.time() - next_tick) // HEARTBEAT_TICK)
+            next_tick += behind * HEARTBEAT_TICK
+            for _ in range(min(behind + 1, len(self.slots))):
+                self.cursor = (self.cursor + 1) % len(self.slots)
+                due, self.slots[self.cursor] = self.slots[self.cursor], set()
+                for session in due:
+                    session.slot = None
+                    check = asyncio.create_task(self.guarded_check(session))
+                    self.checks.add(check)
+                    check.add_done_callback(self.checks.discard)
+
+    async def guarded_check(self, session: Session):
+        try:
+            await self.check(session)
+        except Exception as e:
+            logger.error("Heartbeat check for %s failed: %s", session.user_id, e)
+
+    async def check(self, session: Session):
+        if not session.active:
+            return
+        now = time.time()
+        if session.pinged_at is not None and session.last_seen < session.pinged_at:
+            await self.reap(session)
+        elif now - session.last_seen >= HEARTBEAT_INTERVAL:
+            session.pinged_at = now
+            self.schedule(session, HEARTBEAT_TIMEOUT)
+            await self.ping(session)
+        else:
+            session.pinged_at = None
+            self.schedule(session, HEARTBEAT_INTERVAL - (now - session.last_seen))
+
+    async def ping(self, session: Session):
+        try:
+            message = '{"type":"ping","timestamp":"' + datetime.now().isoformat() + '"}'
+            await asyncio.wait_for(session.websocket.send_text(message), HEARTBEAT_TIMEOUT)
+            HEARTBEAT_PINGS.inc()
+        except Exception as e:
+            # The next check finds the ping unanswered and reaps the connection
+            FAILED_SENDS.labels(path="ping").inc()
+            log_event("presence", "Failed to ping %s: %s", session.user_id, e, level=logging.WARNING)
+
+    async def reap(self, session: Session):
+        REAPED_CONNECTIONS.inc()
+        logger.info("Closing connection for %s: no answer to ping in %ss", session.user_id, HEARTBEAT_TIMEOUT)
+        await manager.drop(session)
+        await manager.close_session(session, 1001, "No answer to ping")
+
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections = {}
+        self.active_connections = {}  # user ID -> [Session, ...], oldest first
+        self.session_count = 0
+        self.closing = set()  # close() calls still waiting on a displaced socket
+        self.flushing = set()  # coalesced frames being sent
+        self.notifying = set()  # presence notices being sent
+        self.rooms = {}       # room -> set of local user IDs
+        self.user_rooms = {}  # user ID -> set of rooms joined
+        self.watchers = {}    # user ID -> set of local user IDs watching them
+        self.watching = {}    # local user ID -> set of user IDs they watch
+        # Buckets of users whose last session closed, kept until they refill
+        # so reconnecting doesn't reset a spent limit; oldest first
+        self.parked_buckets = OrderedDict()
         self.pubsub = None
         self.listener_task = None
-        self.initialize_redis()
     
-    def initialize_redis(self):
-        """Initialize Redis PubSub connection with proper error handling"""
-        if redis_client:
+    def local_channels(self):
+        """Channels this replica needs for itself and the rooms its users are in"""
+        channels = [replica_channel(REPLICA_ID)]
+        channels.extend(room_channel(room) for room in self.rooms)
+        channels.extend(watch_channel(user_id) for user_id in self.watchers)
+        return channels
+
+    async def subscribe(self, channel: str):
+        if self.pubsub:
+            try:
+                await self.pubsub.subscribe(channel)
+            except Exception as e:
+                logger.error("Failed to subscribe to %s: %s", channel, e)
+
+    async def unsubscribe(self, channel: str):
+        if self.pubsub:
+            try:
+                await self.pubsub.unsubscribe(channel)
+            except Exception as e:
+                logger.error("Failed to unsubscribe from %s: %s", channel, e)
+
+    async def initialize_redis(self):
+        """Initialize the asyncio Redis PubSub connection with proper error handling"""
+        if pubsub_client:
+            # Give the old subscription's connection back before opening another
+            await self.close_pubsub()
             try:
-                self.pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
-                self.pubsub.subscribe('chat_messages')
-                logger.info("Successfully subscribed to Redis 'chat_messages' channel")
+                self.pubsub = pubsub_client.pubsub(ignore_subscribe_messages=True)
+                # Re-subscribe rooms and watches added while Redis was away
+                await self.pubsub.subscribe(SYSTEM_CHANNEL, *self.local_channels())
+                logger.info("Successfully subscribed to Redis '%s' channel", SYSTEM_CHANNEL)
                 # Test Redis pub/sub
                 test_message = {
                     'type': 'system',
                     'text': 'Redis pub/sub test message',
                     'timestamp': datetime.now().isoformat()
                 }
-                redis_client.publish('chat_messages', json.dumps(test_message))
-                logger.info(f"Published test message to Redis: {test_message}")
+                await redis_client.publish(SYSTEM_CHANNEL, json.dumps(test_message))
+                logger.info("Published test message to Redis: %s", test_message)
+            except Exception as e:
+                logger.error("Failed to initialize Redis PubSub: %s", e)
+                await self.close_pubsub()
+
+    async def close_pubsub(self):
+        pubsub, self.pubsub = self.pubsub, None
+        if pubsub is not None:
+            try:
+                await pubsub.close()
             except Exception as e:
-                logger.error(f"Failed to initialize Redis PubSub: {e}")
-                self.pubsub = None
+                logger.debug("Closing the Redis PubSub failed: %s", e)
 
     async def start_redis_listener(self):
         """Start the Redis message listener in a proper async context"""
+        if not self.pubsub:
+            await self.initialize_redis()
         if not self.listener_task and self.pubsub:
             self.listener_task = asyncio.create_task(self.redis_listener())
             logger.info("Redis listener task started")
@@ -127,16 +1278,16 @@ class ConnectionManager:
             logger.info("Redis reconnection task started")
 
     async def redis_reconnector(self):
-        """Periodically try to reconnect to Redis if it's not available"""
-        while True:
-            if not self.pubsub and redis_client:
+        """Keep retrying the Redis subscription, backing off between attempts"""
+        for delay in backoff_delays():
+            await asyncio.sleep(delay)
+            if not self.pubsub and pubsub_client:
                 logger.info("Attempting to reconnect Redis pubsub...")
-                self.initialize_redis()
+                await self.initialize_redis()
                 if self.pubsub:
                     logger.info("Redis reconnected, starting listener...")
-                    asyncio.create_task(self.redis_listener())
+                    self.listener_task = asyncio.create_task(self.redis_listener())
                     break
-            await asyncio.sleep(10)  # Try reconnecting every 10 seconds
 
     async def redis_listener(self):
         """Listen for messages from Redis and forward them to the appropriate WebSocket connections"""
@@ -148,67 +1299,203 @@ class ConnectionManager:
         try:
             while True:
                 try:
-                    message = self.pubsub.get_message()
+                    # Wait on the socket until Redis pushes something. Replies that
+                    # are already buffered are parsed without suspending, so a burst
+                    # is drained in a single wakeup instead of one poll per message.
+                    message = await self.pubsub.get_message(timeout=None)
                     if message and message['type'] == 'message':
-                        logger.info(f"Received message from Redis: {message}")
-                        try:
-                            data = json.loads(message['data'])
-                            
-                            # Skip processing if it's a system message
-                            if data.get('type') == 'system':
-                                logger.info(f"Redis listener received system message: {data.get('text')}")
-                                continue
-
-                            user_id = data.get('to')
-                            logger.info(f"Processing message to user {user_id}. Active connections: {list(self.active_connections.keys())}")
-                            
-                            if user_id in self.active_connections:
-                                formatted_message = json.dumps({
-                                    'from': data.get('from'),
-                                    'text': data.get('text'),
-                                    'timestamp': data.get('timestamp')
-                                })
-                                
-                                # Use direct WebSocket delivery
-                                try:
-                                    await self.active_connections[user_id].send_text(formatted_message)
-                                    logger.info(f"Message sent to {user_id} successfully via Redis")
-                                except Exception as e:
-                                    logger.error(f"Error sending message to {user_id}: {str(e)}")
-                                    # Handle disconnected socket
-                                    if user_id in self.active_connections:
-                                        self.disconnect(user_id)
-                            else:
-                                logger.warning(f"Cannot deliver message: User {user_id} not connected or not found")
-                        except json.JSONDecodeError as e:
-                            logger.error(f"Failed to decode message data: {message['data']}: {str(e)}")
-                        except Exception as e:
-                            logger.error(f"Error processing Redis message: {str(e)}")
-                    
-                    # Small delay to prevent CPU overuse
-                    await asyncio.sleep(0.01)
+                        await self.handle_redis_message(message)
                 except redis.RedisError as e:
-                    logger.error(f"Redis error in listener: {str(e)}")
+                    logger.error("Redis error in listener: %s", e)
                     await asyncio.sleep(1)  # Wait a bit on Redis error
                     # Try to reconnect Redis
-                    self.initialize_redis()
-                    if not self.pubsub:  # If reconnection failed, exit the loop
+                    await self.initialize_redis()
+                    if not self.pubsub:  # If reconnection failed, hand over to the reconnector
+                        self.listener_task = asyncio.create_task(self.redis_reconnector())
                         break
                 except Exception as e:
-                    logger.error(f"Unexpected error in Redis listener: {str(e)}")
+                    logger.error("Unexpected error in Redis listener: %s", e)
                     await asyncio.sleep(1)  # Longer delay on error
         except asyncio.CancelledError:
             logger.info("Redis listener task was cancelled")
         except Exception as e:
-            logger.error(f"Redis listener crashed: {str(e)}")
+            logger.error("Redis listener crashed: %s", e)
             # Try to restart the listener
             if not self.listener_task.cancelled():
                 self.listener_task = asyncio.create_task(self.redis_listener())
 
-    async def connect(self, websocket: WebSocket, user_id: str):
+    async def handle_redis_message(self, message):
+        """Forward a single pub/sub message to the local WebSockets it is addressed to"""
+        channel = message['channel']
+        log_event("redis", "Received message from Redis on %s", channel)
+        try:
+            # Skip processing if it's a system message
+            if channel == SYSTEM_CHANNEL:
+                data = json.loads(message['data'])
+                logger.info("Redis listener received system message: %s", data.get('text'))
+                return
+
+            if channel.startswith(WATCH_CHANNEL_PREFIX):
+                origin, user_id, text = orjson.loads(message['data'])
+                if origin != REPLICA_ID:
+                    self.notify_presence(user_id, text)
+                return
+
+            origin, sender, received_at, recipient, envelope_text = decode_relay(message['data'])
+            # Local recipients were served when this replica published it
+            if origin == REPLICA_ID:
+                return
+            if history_cache.tracks(sender) or history_cache.tracks(recipient):
+                history_cache.remember(orjson.loads(envelope_text))
+
+            if channel.startswith(ROOM_CHANNEL_PREFIX):
+                recipients = self.room_recipients(channel[len(ROOM_CHANNEL_PREFIX):], sender)
+                await self.deliver(envelope_text, recipients, "redis", received_at)
+            elif not await self.deliver(envelope_text, [recipient], "redis", received_at):
+                # The recipient left after the sender looked them up, and the
+                # sender counted us as a receiver, so it won't queue the message.
+                # Other replicas still hosting them got their own copy.
+                if not [host for host in await presence.locate(recipient) if host != REPLICA_ID]:
+                    await self.queue_pending(recipient, envelope_text, sender, received_at)
+        except ValueError as e:
+            logger.error("Failed to decode message data on %s: %s", channel, e)
+        except Exception as e:
+            logger.error("Error processing Redis message: %s", e)
+
+    def room_recipients(self, room: str, sender: str):
+        return [user_id for user_id in self.rooms.get(room, ()) if user_id != sender]
+
+    async def deliver(self, envelope_text: str, recipients, path: str, received_at=None):
+        """Send an already-encoded envelope to each locally connected recipient"""
+        delivered = 0
+        for user_id in recipients:
+            if WS_COALESCE_WINDOW > 0:
+                if self.coalesce(envelope_text, user_id, path, received_at):
+                    delivered += 1
+            elif await self.send_personal_message(envelope_text, user_id, path):
+                observe_delivery(path, received_at)
+                delivered += 1
+        return delivered
+
+    def coalesce(self, envelope_text: str, user_id: str, path: str, received_at=None):
+        """Add a message to the next coalesced frame of each of the user's sessions"""
+        sessions = self.active_connections.get(user_id)
+        if not sessions:
+            log_event("delivery", "Cannot send message to %s: user not connected", user_id, level=logging.WARNING)
+            return False
+        for session in sessions:
+            if session.outbox is None:
+                session.outbox = []
+                asyncio.get_running_loop().call_later(WS_COALESCE_WINDOW, self.flush_outbox, session)
+            session.outbox.append((envelope_text, path, received_at))
+            if len(session.outbox) >= WS_COALESCE_MAX_MESSAGES:
+                self.flush_outbox(session)
+        return True
+
+    def flush_outbox(self, session: Session):
+        outbox, session.outbox = session.outbox, None
+        if outbox and session.active:
+            task = asyncio.create_task(self.send_coalesced(session, outbox))
+            self.flushing.add(task)
+            task.add_done_callback(self.flushing.discard)
+
+    async def send_coalesced(self, session: Session, outbox):
+        """Send the messages held for a session as one frame"""
+        if len(outbox) == 1:
+            frame = outbox[0][0]
+        else:
+            # The envelopes are already serialized, so the array is just joined
+            frame = "[" + ",".join(envelope_text for envelope_text, _, _ in outbox) + "]"
+        try:
+            await session.websocket.send_text(frame)
+        except Exception as e:
+            FAILED_SENDS.labels(path=outbox[0][1]).inc()
+            logger.error("Error sending %s coalesced messages to %s: %s", len(outbox), session.user_id, e)
+            await self.drop(session)
+            return
+        session.messages_out += len(outbox)
+        COALESCED_MESSAGES.observe(len(outbox))
+        for _, path, received_at in outbox:
+            observe_delivery(path, received_at)
+        log_event("delivery", "Sent %s messages to %s in one frame", len(outbox), session.user_id)
+
+    def register(self, session: Session):
+        """Add a session; returns the sessions it displaces on the same device or over the cap"""
+        # A short list rather than a dict per user: it is capped at
+        # MAX_SESSIONS_PER_USER, so scanning it is still constant time
+        sessions = self.active_connections.get(session.user_id)
+        if sessions is None:
+            sessions = self.active_connections[session.user_id] = []
+        # The user's sessions share one bucket, so more sockets don't buy more
+        # messages, and a user who just left gets theirs back
+        if sessions:
+            session.bucket = sessions[0].bucket
+        else:
+            self.prune_buckets()
+            session.bucket = self.parked_buckets.pop(session.user_id, None) or TokenBucket()
+        displaced = [old for old in sessions if old.device == session.device]
+        for old in displaced:
+            sessions.remove(old)
+        while len(sessions) >= MAX_SESSIONS_PER_USER:
+            displaced.append(sessions.pop(0))
+        for old in displaced:
+            old.active = False
+            heartbeats.forget(old)
+        sessions.append(session)
+        self.session_count += 1 - len(displaced)
+        heartbeats.track(session)
+        return displaced
+
+    def unregister(self, session: Session):
+        """Remove a session; returns True if it was the user's last one on this replica"""
+        if not session.active:
+            return False
+        session.active = False
+        heartbeats.forget(session)
+        self.session_count -= 1
+        sessions = self.active_connections[session.user_id]
+        sessions.remove(session)
+        if sessions:
+            return False
+        del self.active_connections[session.user_id]
+        self.park_bucket(session.user_id, session.bucket)
+        return True
+
+    def park_bucket(self, user_id: str, bucket: TokenBucket):
+        if RATE_LIMIT_PER_SECOND <= 0 or bucket is None:
+            return
+        self.prune_buckets()
+        if bucket.full_at() > time.monotonic():
+            self.parked_buckets[user_id] = bucket
+            self.parked_buckets.move_to_end(user_id)
+
+    def prune_buckets(self):
+        """Forget parked buckets that have refilled; none is kept past RATE_LIMIT_BURST / RATE_LIMIT_PER_SECOND seconds"""
+        now = time.monotonic()
+        while self.parked_buckets:
+            bucket = next(iter(self.parked_buckets.values()))
+            if bucket.full_at() > now:
+                break
+            self.parked_buckets.popitem(last=False)
+
+    async def close_session(self, session: Session, code: int, reason: str):
+        try:
+            await asyncio.wait_for(session.websocket.close(code=code, reason=reason), HEARTBEAT_TIMEOUT)
+        except Exception as e:
+            logger.debug("Closing a connection for %s failed: %s", session.user_id, e)
+
+    async def connect(self, websocket: WebSocket, user_id: str, device: Optional[str] = None):
         await websocket.accept()
-        self.active_connections[user_id] = websocket
-        logger.info(f"User {user_id} connected. Active connections: {list(self.active_connections.keys())}")
+        first = user_id not in self.active_connections
+        session = Session(user_id, device or next(session_ids), websocket)
+        for old in self.register(session):
+            # Don't hold up the new connection on a socket that may be half-open
+            task = asyncio.create_task(self.close_session(old, 4000, "Replaced by a newer connection"))
+            self.closing.add(task)
+            task.add_done_callback(self.closing.discard)
+        # Only the user's first session in the whole cluster announces them
+        announce = first and await presence.join(user_id)
+        logger.info("User %s connected. Active connections: %s", user_id, self.session_count)
         
         # Test WebSocket connection by sending a system message
         try:
@@ -218,40 +1505,218 @@ class ConnectionManager:
                 "timestamp": datetime.now().isoformat()
             }
             await websocket.send_text(json.dumps(welcome_message))
-            logger.info(f"Welcome message sent to {user_id}")
+            logger.debug("Welcome message sent to %s", user_id)
+
+            # Hand over anything that arrived while the user was offline
+            await self.deliver_pending(websocket, user_id)
             
             # Notify other users that this user has connected
-            other_user_id = 'B' if user_id == 'A' else 'A'
-            if other_user_id in self.active_connections:
-                notification_message = {
-                    "from": "system",
-                    "text": f"User {user_id} is now online and ready to chat!",
-                    "timestamp": datetime.now().isoformat()
-                }
-                await self.active_connections[other_user_id].send_text(json.dumps(notification_message))
-                logger.info(f"Sent connection notification about User {user_id} to User {other_user_id}")
+            if announce:
+                await self.announce_presence(user_id, f"User {user_id} is now online and ready to chat!")
+        except Exception as e:
+            logger.error("Failed to send welcome message to %s: %s", user_id, e)
+        return session
+
+    async def disconnect(self, session: Session):
+        """Drop a session; returns True if the user has no connections left on any replica"""
+        if not self.unregister(session):
+            return False
+        user_id = session.user_id
+        offline = await presence.leave(user_id)
+        for room in list(self.user_rooms.get(user_id, ())):
+            await self.leave_room(user_id, room)
+        await self.unwatch_all(user_id)
+        logger.info("User %s disconnected. Active connections: %s", user_id, self.session_count)
+        return offline
+
+    async def drop(self, session: Session):
+        """Disconnect a session and tell the others if that took the user offline everywhere"""
+        if await self.disconnect(session):
+            await self.announce_presence(session.user_id, f"User {session.user_id} has gone offline.")
+
+    async def queue_pending(self, user_id: str, envelope_text: str, sender: str, received_at=None):
+        """Keep a direct message for a user who is not connected to any replica"""
+        if redis_client is None:
+            logger.error("Cannot queue message for offline user %s: Redis is unavailable", user_id)
+            return False
+        key = pending_key(user_id)
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.rpush(key, envelope_text)
+                pipe.ltrim(key, -PENDING_MAX_MESSAGES, -1)
+                pipe.expire(key, PENDING_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logger.error("Failed to queue message for offline user %s: %s", user_id, e)
+            return False
+        PENDING_MESSAGES.labels(event="queued").inc()
+        log_event("message", "Queued message for offline user %s", user_id)
+        # The user may have connected since the caller looked them up, and
+        # their replica may already have emptied the list. Whichever of us and
+        # deliver_pending removes the message first delivers it.
+        try:
+            # Our own entry may outlive the session that just closed here
+            owners = [owner for owner in await presence.locate(user_id)
+                      if owner != REPLICA_ID or user_id in self.active_connections]
+            if owners and await redis_client.lrem(key, 1, envelope_text):
+                log_event("message", "User %s came online while their message was queued", user_id)
+                await self.relay_direct(envelope_text, sender, user_id, owners, received_at)
         except Exception as e:
-            logger.error(f"Failed to send welcome message to {user_id}: {str(e)}")
+            logger.error("Failed to recheck presence of %s after queuing: %s", user_id, e)
+        return True
 
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            logger.info(f"User {user_id} disconnected. Active connections: {list(self.active_connections.keys())}")
+    async def relay_direct(self, envelope_text: str, sender: str, user_id: str, owners, received_at=None):
+        """Send a direct message to the user's sessions here and on the replicas in owners"""
+        if REPLICA_ID in owners and user_id in self.active_connections:
+            await self.deliver(envelope_text, [user_id], "direct", received_at)
+        channels = [replica_channel(owner) for owner in owners if owner != REPLICA_ID]
+        if channels:
+            relay = encode_relay(envelope_text, sender, received_at, user_id)
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for channel in channels:
+                    pipe.publish(channel, relay)
+                await pipe.execute()
 
-    async def send_personal_message(self, message: str, user_id: str):
-        """Send a message directly via WebSocket connection"""
-        if user_id in self.active_connections:
+    async def deliver_pending(self, websocket: WebSocket, user_id: str):
+        """Send a reconnecting user's queued messages as one frame"""
+        if redis_client is None:
+            return
+        key = pending_key(user_id)
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.lrange(key, 0, -1)
+                pipe.delete(key)
+                envelopes, _ = await pipe.execute()
+        except Exception as e:
+            logger.error("Failed to read queued messages for %s: %s", user_id, e)
+            return
+        if not envelopes:
+            return
+        # The envelopes are already serialized, so the batch is just joined
+        frame = '{"type":"pending","messages":[' + ",".join(envelopes) + "]}"
+        try:
+            await websocket.send_text(frame)
+            PENDING_MESSAGES.labels(event="delivered").inc(len(envelopes))
+            logger.info("Delivered %s queued messages to %s", len(envelopes), user_id)
+        except Exception as e:
+            # The messages are still in MongoDB and show up in the history API
+            FAILED_SENDS.labels(path="pending").inc()
+            logger.error("Failed to deliver %s queued messages to %s: %s", len(envelopes), user_id, e)
+
+    async def announce_presence(self, user_id: str, text: str):
+        """Tell the users watching user_id, on any replica, that they came online or went offline"""
+        self.notify_presence(user_id, text)
+        if redis_client is not None:
             try:
-                await self.active_connections[user_id].send_text(message)
-                logger.info(f"Direct message sent to {user_id}")
-                return True
+                # Only replicas with a local watcher are subscribed
+                await redis_client.publish(watch_channel(user_id), orjson.dumps([REPLICA_ID, user_id, text]))
             except Exception as e:
-                logger.error(f"Error sending direct message to {user_id}: {str(e)}")
-                # Handle disconnected socket
-                self.disconnect(user_id)
-                return False
+                logger.error("Failed to publish presence of %s: %s", user_id, e)
+
+    def notify_presence(self, user_id: str, text: str):
+        """Tell the local users watching user_id that they came online or went offline"""
+        watchers = self.watchers.get(user_id)
+        if not watchers:
+            return
+        sessions = [session for watcher in watchers for session in self.active_connections.get(watcher, ())]
+        notification_message = json.dumps({
+            "from": "system",
+            "text": text,
+            "timestamp": datetime.now().isoformat()
+        })
+        # Sent in the background, so a slow socket never holds up connect() or the Redis listener
+        task = asyncio.create_task(self.send_presence(user_id, notification_message, sessions))
+        self.notifying.add(task)
+        task.add_done_callback(self.notifying.discard)
+
+    async def send_presence(self, user_id: str, notification_message: str, sessions):
+        results = await asyncio.gather(
+            *(asyncio.wait_for(session.websocket.send_text(notification_message), HEARTBEAT_TIMEOUT)
+              for session in sessions),
+            return_exceptions=True)
+        for session, result in zip(sessions, results):
+            if isinstance(result, Exception):
+                FAILED_SENDS.labels(path="presence").inc()
+                logger.error("Error sending presence notification to %s: %s", session.user_id, result)
+            else:
+                log_event("presence", "Sent presence notification about User %s to User %s", user_id, session.user_id)
+
+    async def watch(self, user_id: str, *others):
+        """Send user_id presence notices about the given users"""
+        watched = self.watching.setdefault(user_id, set())
+        for other in others:
+            if other == user_id or other in watched or len(watched) >= MAX_WATCHED_USERS:
+                continue
+            watched.add(other)
+            watchers = self.watchers.get(other)
+            if watchers is None:
+                watchers = self.watchers[other] = set()
+                # First local watcher: start receiving their notices on this replica
+                await self.subscribe(watch_channel(other))
+            watchers.add(user_id)
+
+    async def unwatch_all(self, user_id: str):
+        for other in self.watching.pop(user_id, ()):
+            watchers = self.watchers.get(other)
+            if watchers is None:
+                continue
+            watchers.discard(user_id)
+            if not watchers:
+                del self.watchers[other]
+                await self.unsubscribe(watch_channel(other))
+
+    async def join_room(self, user_id: str, room: str):
+        """Add user_id to a room; returns False if they are already in MAX_ROOMS_PER_USER others"""
+        joined = self.user_rooms.get(user_id, ())
+        if room in joined:
+            return True
+        if len(joined) >= MAX_ROOMS_PER_USER:
+            return False
+        members = self.rooms.get(room)
+        if members is None:
+            members = self.rooms[room] = set()
+            # First local member: start receiving the room's traffic on this replica
+            await self.subscribe(room_channel(room))
+        members.add(user_id)
+        self.user_rooms.setdefault(user_id, set()).add(room)
+        logger.info("User %s joined room %s", user_id, room)
+        return True
+
+    async def leave_room(self, user_id: str, room: str):
+        members = self.rooms.get(room)
+        if members is None or user_id not in members:
+            return
+        members.discard(user_id)
+        joined = self.user_rooms.get(user_id)
+        if joined is not None:
+            joined.discard(room)
+            if not joined:
+                del self.user_rooms[user_id]
+        if not members:
+            del self.rooms[room]
+            await self.unsubscribe(room_channel(room))
+        logger.info("User %s left room %s", user_id, room)
+
+    async def send_personal_message(self, message: str, user_id: str, path: str = "direct"):
+        """Send a message to every device the user has connected to this replica"""
+        sessions = self.active_connections.get(user_id)
+        if sessions:
+            sent = False
+            for session in list(sessions):
+                try:
+                    await session.websocket.send_text(message)
+                    session.messages_out += 1
+                    sent = True
+                except Exception as e:
+                    FAILED_SENDS.labels(path=path).inc()
+                    logger.error("Error sending direct message to %s: %s", user_id, e)
+                    # Handle disconnected socket
+                    await self.drop(session)
+            if sent:
+                log_event("delivery", "Message sent to %s via %s", user_id, path)
+            return sent
         else:
-            logger.warning(f"Cannot send message to {user_id}: user not connected")
+            log_event("delivery", "Cannot send message to %s: user not connected", user_id, level=logging.WARNING)
             return False
 
     async def handle_ping(self, websocket: WebSocket, user_id: str):
@@ -262,167 +1727,446 @@ class ConnectionManager:
                 "timestamp": datetime.now().isoformat()
             }
             await websocket.send_text(json.dumps(pong_message))
-            logger.debug(f"Sent pong to {user_id}")
+            logger.debug("Sent pong to %s", user_id)
             return True
         except Exception as e:
-            logger.error(f"Error sending pong to {user_id}: {str(e)}")
+            FAILED_SENDS.labels(path="pong").inc()
+            logger.error("Error sending pong to %s: %s", user_id, e)
             return False
 
-    async def publish_message(self, message_data):
-        """Publish a message to Redis and store in MongoDB"""
+    async def publish_message(self, message_data, received_at=None, owners=None):
+        """Deliver a message locally, relay it to other replicas via Redis and store it in MongoDB.
+
+        owners are the replicas hosting a direct message's recipient, when the
+        caller has already looked them up.
+        """
         try:
-            # Add timestamp if not present
-            if 'timestamp' not in message_data:
-                message_data['timestamp'] = datetime.now().isoformat()
-                
-            # Log detailed message info
-            from_user = message_data.get('from')
-            to_user = message_data.get('to')
-            text = message_data.get('text')
-            logger.info(f"Processing message: From={from_user}, To={to_user}, Text={text}")
+            envelope = build_envelope(message_data)
+            envelope_text = orjson.dumps(envelope).decode()
+            from_user = envelope['from']
+            to_user = envelope.get('to')
+            room = envelope.get('room')
+            log_event("message", "Processing message: From=%s, To=%s, Room=%s", from_user, to_user, room)
             
             # Store message in MongoDB if available - Fix the MongoDB collection check
             if messages_collection is not None:
                 message_record = {
+                    '_id': ObjectId(envelope['id']),
                     'from': from_user,
                     'to': to_user,
-                    'text': text,
-                    'timestamp': message_data.get('timestamp')
+                    'text': envelope['text'],
+                    'timestamp': envelope['timestamp']
                 }
-                messages_collection.insert_one(message_record)
-                logger.info(f"Message stored in MongoDB: {message_record}")
-            
-            # Create formatted message for WebSocket delivery
-            formatted_message = json.dumps({
-                'from': from_user,
-                'text': text,
-                'timestamp': message_data.get('timestamp')
-            })
-            
-            # First try direct delivery for immediate feedback
-            direct_delivery = False
-            if to_user in self.active_connections:
-                logger.info(f"Attempting direct delivery to {to_user}")
-                direct_delivery = await self.send_personal_message(formatted_message, to_user)
-                if direct_delivery:
-                    logger.info(f"Successfully delivered message directly to {to_user}")
+                if room:
+                    message_record['room'] = room
+                if await message_writer.enqueue(message_record):
+                    await history_cache.record(envelope)
+
+            if room:
+                # Serve members on this replica straight away; the Redis copy
+                # carries our replica ID so our own listener drops it
+                channels = [room_channel(room)]
+                delivered = await self.deliver(envelope_text, self.room_recipients(room, from_user), "direct", received_at)
+            else:
+                # The recipient's devices on this replica are served directly,
+                # and every other replica hosting one of them gets one copy
+                delivered = 0
+                if to_user in self.active_connections:
+                    delivered = await self.deliver(envelope_text, [to_user], "direct", received_at)
+                if owners is None:
+                    owners = await presence.locate(to_user)
+                channels = [replica_channel(owner) for owner in owners if owner != REPLICA_ID]
+                if not channels:
+                    return True if delivered else await self.queue_pending(to_user, envelope_text, from_user, received_at)
             
-            # Also publish to Redis to ensure delivery through subscription system
             if redis_client is not None:
                 try:
-                    # Use json.dumps to ensure proper serialization
-                    redis_message = json.dumps(message_data)
-                    redis_client.publish('chat_messages', redis_message)
-                    logger.info(f"Message published to Redis: {redis_message}")
+                    relay = encode_relay(envelope_text, from_user, received_at, to_user)
+                    with REDIS_PUBLISH_SECONDS.time():
+                        if len(channels) == 1:
+                            receivers = await redis_client.publish(channels[0], relay)
+                        else:
+                            async with redis_client.pipeline(transaction=False) as pipe:
+                                for channel in channels:
+                                    pipe.publish(channel, relay)
+                                receivers = sum(await pipe.execute())
+                    log_event("message", "Message published to Redis on %s", ", ".join(channels))
+                    # The owners stopped without unregistering their users
+                    if not room and not receivers and not delivered:
+                        return await self.queue_pending(to_user, envelope_text, from_user, received_at)
                     return True
                 except Exception as e:
-                    logger.error(f"Failed to publish to Redis: {str(e)}")
-                    if not direct_delivery:
+                    logger.error("Failed to publish to Redis: %s", e)
+                    if not delivered:
                         # If Redis failed and direct delivery also failed, log error
-                        logger.error(f"Complete message delivery failure to {to_user}")
-                        return False
-                    return direct_delivery
+                        logger.error("Complete message delivery failure on %s", ", ".join(channels))
+                    return delivered > 0
             else:
                 # If no Redis, rely only on direct delivery result
-                if not direct_delivery:
-                    logger.error(f"Cannot deliver message to {to_user}: No Redis and WebSocket delivery failed")
-                    return False
-                return direct_delivery
+                if not delivered:
+                    logger.error("Cannot deliver message on %s: No Redis and WebSocket delivery failed", ", ".join(channels))
+                return delivered > 0
         except Exception as e:
-            logger.error(f"Error in publish_message: {str(e)}")
+            logger.error("Error in publish_message: %s", e)
             return False
 
 
+message_writer = MessageWriter()
+history_cache = HistoryCache()
+presence = PresenceRegistry()
+heartbeats = HeartbeatScheduler()
 manager = ConnectionManager()
+GAUGE_FUNCTIONS = [
+    (ACTIVE_CONNECTIONS, lambda: manager.session_count),
+    (HISTORY_CACHE_ENTRIES, lambda: len(history_cache.entries)),
+    (HISTORY_CACHE_BYTES, lambda: history_cache.size),
+    (MONGO_WRITE_QUEUE_DEPTH, lambda: message_writer.queue.qsize() if message_writer.queue else 0),
+]
+if not METRICS_MULTIPROCESS:
+    for gauge, value in GAUGE_FUNCTIONS:
+        gauge.set_function(value)
 
-# Start the Redis listener when the app starts
-@app.on_event("startup")
-async def startup_event():
-    """Start background tasks when the app starts"""
-    logger.info("Application starting up...")
-    await manager.start_redis_listener()
-
+async def publish_gauges():
+    """Copy the gauges into this worker's metrics file, since scrapes may land on another worker"""
+    while True:
+        for gauge, value in GAUGE_FUNCTIONS:
+            gauge.set(value())
+        await asyncio.sleep(1)
 
 @app.get("/")
 async def get():
     # Check real Redis connection status
     redis_status = "Connected" if redis_client and manager.pubsub else "Disconnected"
-    mongo_status = "Connected" if messages_collection else "Disconnected"
-    active_users = list(manager.active_connections.keys())
+    mongo_status = "Connected" if messages_collection is not None else "Disconnected"
+    local_users = list(manager.active_connections.keys())
+    # Users on every replica, from the presence registry
+    try:
+        active_users = await presence.online_users() if redis_client is not None else local_users
+    except Exception as e:
+        logger.error("Failed to list online users: %s", e)
+        active_users = local_users
     
     return {
         "status": "WebSocket server running",
         "redis": redis_status,
         "mongodb": mongo_status,
-        "active_users": active_users
+        "replica": REPLICA_ID,
+        "active_users": active_users,
+        "local_users": local_users,
+        "local_sessions": manager.session_count,
+        "rooms": list(manager.rooms.keys())
     }
 
 
-# New endpoint to get message history
+@app.get("/healthz")
+async def liveness():
+    """Liveness probe: the event loop is answering, whatever the dependencies are doing"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readiness(response: Response):
+    """Readiness probe: only route traffic here while Redis and MongoDB both answer"""
+    redis_ok, mongo_ok = await asyncio.gather(redis_ready(), mongo_ready())
+    if not (redis_ok and mongo_ok):
+        response.status_code = 503
+    return {"redis": redis_ok, "mongodb": mongo_ok}
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint"""
+    if METRICS_MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+# Message history is paged with an opaque keyset cursor "<timestamp>_<ObjectId>"
+HISTORY_DEFAULT_LIMIT = 100
+HISTORY_MAX_LIMIT = int(os.environ.get("HISTORY_MAX_LIMIT", 500))
+HISTORY_PROJECTION = {"_id": 1, "from": 1, "to": 1, "text": 1, "timestamp": 1}
+
+def encode_history_cursor(timestamp, message_id):
+    return f"{timestamp}_{message_id}"
+
+def decode_history_cursor(cursor: str):
+    try:
+        timestamp, object_id = cursor.rsplit("_", 1)
+        return timestamp, ObjectId(object_id)
+    except (ValueError, InvalidId):
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+
+def build_history_query(user_id: str, bound=None, operator="$lt"):
+    """Messages sent or received by user_id, optionally strictly before/after a cursor.
+
+    The keyset condition is repeated inside each branch of the $or so every
+    branch stays a bounded scan of its (from|to, timestamp, _id) index.
+    """
+    branches = []
+    for field in ("from", "to"):
+        if bound is None:
+            branches.append({field: user_id})
+        else:
+            timestamp, object_id = bound
+            branches.append({field: user_id, "timestamp": {operator: timestamp}})
+            branches.append({field: user_id, "timestamp": timestamp, "_id": {operator: object_id}})
+    return {"$or": branches}
+
+def query_message_history(user_id: str, limit: int, before=None, after=None):
+    """Run the history query synchronously; meant to be called off the event loop"""
+    if after is not None:
+        query = build_history_query(user_id, after, "$gt")
+        direction = pymongo.ASCENDING
+    else:
+        query = build_history_query(user_id, before, "$lt")
+        direction = pymongo.DESCENDING
+
+    # Fetch one extra row to know whether another page exists
+    cursor = messages_collection.find(query, HISTORY_PROJECTION) \
+        .sort([("timestamp", direction), ("_id", direction)]) \
+        .limit(limit + 1)
+    rows = list(cursor)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == pymongo.DESCENDING:
+        rows.reverse()
+    return rows, has_more
+
+
 @app.get("/messages/{user_id}")
-async def get_message_history(user_id: str):
-    """Get message history for a specific user"""
+async def get_message_history(
+    user_id: str,
+    limit: int = Query(HISTORY_DEFAULT_LIMIT, ge=1),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+):
+    """Get a page of message history for a specific user, oldest first.
+
+    Without a cursor the most recent `limit` messages are returned. Pass the
+    returned `before` cursor to page further back, or `after` to fetch newer
+    messages.
+    """
     try:
         if messages_collection is None:
             logger.error("Cannot retrieve message history: MongoDB not connected")
             raise HTTPException(status_code=503, detail="Database not available")
-        
-        logger.info(f"Retrieving message history for user {user_id}")
-        
-        # Find all messages where the user is either sender or recipient
-        query = {"$or": [{"from": user_id}, {"to": user_id}]}
-        
-        # Sort by timestamp and limit to most recent 100 messages
-        cursor = messages_collection.find(query).sort("timestamp", 1).limit(100)
-        
-        # Convert to list and format for response
-        messages = []
-        for msg in cursor:
-            # MongoDB ObjectId is not JSON serializable, so we convert it to string
-            msg["_id"] = str(msg["_id"])
-            messages.append(msg)
-        
-        logger.info(f"Retrieved {len(messages)} messages for user {user_id}")
-        return {"messages": messages}
+        if before and after:
+            raise HTTPException(status_code=400, detail="Use either 'before' or 'after', not both")
+
+        limit = min(limit, HISTORY_MAX_LIMIT)
+        if before is None and after is None and history_cache.enabled:
+            # The page every client loads first; usually answered from memory
+            rows, first, last, has_more = await history_cache.read(user_id, limit)
+            log_event("history", "Retrieved %s messages for user %s", len(rows), user_id)
+            return {
+                "messages": rows,
+                "before": encode_history_cursor(*first) if first else None,
+                "after": encode_history_cursor(*last) if last else None,
+                "has_more": has_more
+            }
+
+        before_bound = decode_history_cursor(before) if before else None
+        after_bound = decode_history_cursor(after) if after else None
+
+        rows, has_more = await asyncio.to_thread(
+            query_message_history, user_id, limit, before_bound, after_bound
+        )
+
+        # Only the page boundaries need their ObjectId turned into a cursor
+        page_before = encode_history_cursor(rows[0]["timestamp"], rows[0]["_id"]) if rows else before
+        page_after = encode_history_cursor(rows[-1]["timestamp"], rows[-1]["_id"]) if rows else after
+        for msg in rows:
+            del msg["_id"]
+
+        log_event("history", "Retrieved %s messages for user %s", len(rows), user_id)
+        return {
+            "messages": rows,
+            "before": page_before,
+            "after": page_after,
+            "has_more": has_more
+        }
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error retrieving message history: {str(e)}")
+        logger.error("Error retrieving message history: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to retrieve message history: {str(e)}")
 
 
+# Search results are ranked by MongoDB's text score, so they page by offset
+# rather than by keyset; SEARCH_MAX_RESULTS caps how deep a client can page.
+# The text index cannot be prefixed by user (a message has two participants,
+# and MongoDB rejects a multikey prefix on a text index), so a common word
+# matches every user's messages before the from/to filter applies;
+# SEARCH_MAX_TIME_MS stops such a query server-side instead of letting it
+# run on.
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", 1000))
+SEARCH_MAX_TIME_MS = int(os.environ.get("SEARCH_MAX_TIME_MS", 2000))
+SEARCH_PROJECTION = {"_id": 0, "from": 1, "to": 1, "text": 1, "timestamp": 1, "room": 1,
+                     "score": {"$meta": "textScore"}}
+
+def search_messages(user_id: str, q: str, limit: int, offset: int):
+    """Run the search query synchronously; meant to be called off the event loop.
+
+    The text index yields the matching messages and only those are fetched
+    and filtered down to the user's own conversations, best match first.
+    """
+    query = {"$text": {"$search": q}, "$or": [{"from": user_id}, {"to": user_id}]}
+    cursor = messages_collection.find(query, SEARCH_PROJECTION) \
+        .sort([("score", {"$meta": "textScore"}), ("timestamp", pymongo.DESCENDING)]) \
+        .skip(offset) \
+        .limit(limit + 1) \
+        .max_time_ms(SEARCH_MAX_TIME_MS)
+    with SEARCH_SECONDS.time():
+        rows = list(cursor)
+    return rows[:limit], len(rows) > limit
+
+
+@app.get("/messages/{user_id}/search")
+async def search_message_history(
+    user_id: str,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(SEARCH_DEFAULT_LIMIT, ge=1),
+    offset: int = Query(0, ge=0),
+):
+    """Search the messages a user sent or received, best match first.
+
+    `q` uses MongoDB text search syntax: words match any stemmed form,
+    "quoted phrases" must appear as-is and -word excludes a word. Pass the
+    returned `next_offset` as `offset` to get the next page.
+    """
+    try:
+        if messages_collection is None:
+            logger.error("Cannot search messages: MongoDB not connected")
+            raise HTTPException(status_code=503, detail="Database not available")
+        limit = min(limit, SEARCH_MAX_LIMIT, max(SEARCH_MAX_RESULTS - offset, 0))
+        if limit == 0:
+            return {"messages": [], "next_offset": None}
+
+        rows, has_more = await asyncio.to_thread(search_messages, user_id, q, limit, offset)
+        next_offset = offset + len(rows)
+        log_event("history", "Search for user %s matched %s messages", user_id, len(rows))
+        return {
+            "messages": rows,
+            "next_offset": next_offset if has_more and next_offset < SEARCH_MAX_RESULTS else None
+        }
+    except HTTPException:
+        raise
+    except pymongo.errors.ExecutionTimeout:
+        logger.warning("Search for user %s timed out after %sms", user_id, SEARCH_MAX_TIME_MS)
+        raise HTTPException(status_code=503, detail="Search took too long; try a more specific query")
+    except Exception as e:
+        logger.error("Error searching messages: %s", e)
+        raise HTTPException(status_code=500, detail=f"Failed to search messages: {str(e)}")
+
+
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(websocket, user_id)
+async def websocket_endpoint(websocket: WebSocket, user_id: str, device: Optional[str] = None):
+    # Clients that pass a stable ?device= replace their own earlier connection
+    # on reconnect; without one every connection counts as a new device
+    session = await manager.connect(websocket, user_id, device)
     try:
         while True:
             data = await websocket.receive_text()
+            received_at = session.last_seen = time.time()
+            session.messages_in += 1
+            if not session.active:
+                # Displaced by a newer connection, or reaped
+                break
+
+            # Enforce the inbound limits before doing any work for the frame
+            if message_too_large(data):
+                THROTTLED_MESSAGES.labels(reason="too_large").inc()
+                log_event("message", "Rejected %s-character message from %s", len(data), user_id, level=logging.WARNING)
+                await websocket.send_text(orjson.dumps({
+                    "type": "error",
+                    "from": "system",
+                    "text": f"Message too large: the limit is {MAX_MESSAGE_BYTES} bytes.",
+                    "max_bytes": MAX_MESSAGE_BYTES,
+                    "timestamp": datetime.now().isoformat()
+                }).decode())
+                continue
+            if RATE_LIMIT_PER_SECOND > 0:
+                retry_after = session.bucket.take()
+                if retry_after:
+                    THROTTLED_MESSAGES.labels(reason="rate_limit").inc()
+                    # Tell the client once per episode instead of echoing a flood
+                    if not session.bucket.throttled:
+                        session.bucket.throttled = True
+                        log_event("message", "Throttling %s", user_id, level=logging.WARNING)
+                        await websocket.send_text(orjson.dumps({
+                            "type": "throttled",
+                            "from": "system",
+                            "text": f"You are sending messages too fast. Try again in {retry_after:.1f} seconds.",
+                            "retry_after": round(retry_after, 3),
+                            "timestamp": datetime.now().isoformat()
+                        }).decode())
+                    continue
+                session.bucket.throttled = False
             try:
-                message_data = json.loads(data)
+                message_data = orjson.loads(data)
                 
                 # Handle ping messages separately
                 if message_data.get('type') == 'ping':
-                    logger.debug(f"Received ping from {user_id}")
+                    logger.debug("Received ping from %s", user_id)
                     await manager.handle_ping(websocket, user_id)
                     continue
+                # Answers to server pings only need to refresh last_seen
+                if message_data.get('type') == 'pong':
+                    continue
+
+                # Presence notices about other users
+                if message_data.get('type') == 'watch':
+                    users = message_data.get('users')
+                    if isinstance(users, list):
+                        await manager.watch(user_id, *(other for other in users if isinstance(other, str)))
+                    continue
+
+                # Room membership changes
+                if message_data.get('type') in ('join', 'leave') and message_data.get('room'):
+                    if message_data['type'] == 'join':
+                        await enter_room(websocket, user_id, message_data['room'])
+                    elif valid_room(message_data['room']):
+                        await manager.leave_room(user_id, message_data['room'])
+                    continue
+
+                MESSAGES_RECEIVED.inc()
+
+                # Room messages go to every member except the sender
+                if message_data.get('room') and 'text' in message_data:
+                    message_data['from'] = user_id
+                    message_data.pop('to', None)
+                    if not await enter_room(websocket, user_id, message_data['room']):
+                        continue
+                    log_event("message", "Received message from %s to room %s", user_id, message_data['room'])
+                    await manager.publish_message(message_data, received_at)
+                    continue
                 
                 # Validate the message format for chat messages
                 if 'to' not in message_data or 'text' not in message_data:
-                    logger.warning(f"Invalid message format from {user_id}: {data}")
+                    logger.warning("Invalid message format from %s (%s bytes)", user_id, len(data))
                     continue
                 
                 # Confirm the sender is correctly identified
                 to_user = message_data.get('to')
-                text = message_data.get('text')
                 
                 # Log the received message
-                logger.info(f"Received message from {user_id} to {to_user}: {text}")
+                log_event("message", "Received message from %s to %s", user_id, to_user)
                 
                 # Add sender info to the message
                 message_data['from'] = user_id
+                # Direct-message contacts get each other's presence notices
+                if isinstance(to_user, str) and to_user not in manager.watching.get(user_id, ()):
+                    await manager.watch(user_id, to_user)
                 
-                # Check if recipient is connected
-                recipient_connected = to_user in manager.active_connections
+                # Check if recipient is connected to this or any other replica
+                owners = await presence.locate(to_user)
+                recipient_connected = bool(owners) or to_user in manager.active_connections
                 if not recipient_connected:
-                    logger.warning(f"Recipient {to_user} is not connected")
+                    log_event("message", "Recipient %s is not connected", to_user, level=logging.WARNING)
                     error_msg = {
                         "from": "system",
                         "text": f"User {to_user} is not currently online. They will receive your message when they connect.",
@@ -431,7 +2175,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     await websocket.send_text(json.dumps(error_msg))
                 
                 # Publish the message via Redis and MongoDB
-                success = await manager.publish_message(message_data)
+                success = await manager.publish_message(message_data, received_at, owners)
                 
                 # Let the sender know if there was a problem that wasn't just the recipient being offline
                 if not success and recipient_connected:
@@ -443,32 +2187,52 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     await websocket.send_text(json.dumps(error_msg))
                     
             except json.JSONDecodeError:
-                logger.error(f"Invalid JSON received from {user_id}: {data}")
+                logger.error("Invalid JSON received from %s (%s bytes)", user_id, len(data))
             except Exception as e:
-                logger.error(f"Error processing message from {user_id}: {str(e)}")
+                logger.error("Error processing message from %s: %s", user_id, e)
                 
     except WebSocketDisconnect:
-        logger.info(f"WebSocket disconnected for user {user_id}")
-        manager.disconnect(user_id)
-        
-        # Notify other users about the disconnection
-        other_user_id = 'B' if user_id == 'A' else 'A'
-        if other_user_id in manager.active_connections:
-            try:
-                disconnect_msg = {
-                    "from": "system",
-                    "text": f"User {user_id} has gone offline.",
-                    "timestamp": datetime.now().isoformat()
-                }
-                await manager.active_connections[other_user_id].send_text(json.dumps(disconnect_msg))
-                logger.info(f"Sent disconnect notification about User {user_id} to User {other_user_id}")
-            except Exception as e:
-                logger.error(f"Error sending disconnect notification: {str(e)}")
+        logger.info("WebSocket disconnected for user %s", user_id)
+        # Notify other users if this was the user's last connection
+        await manager.drop(session)
     except Exception as e:
-        logger.error(f"Error in WebSocket connection for {user_id}: {str(e)}")
-        manager.disconnect(user_id)
+        logger.error("Error in WebSocket connection for %s: %s", user_id, e)
+        await manager.drop(session)
+
+
+def worker_count():
+    """WEB_CONCURRENCY worker processes, or with "auto" one per CPU the container may use"""
+    value = os.environ.get("WEB_CONCURRENCY", "1")
+    if value != "auto":
+        return max(int(value), 1)
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        # cgroup v2 CPU limit, e.g. "300000 100000" for 3 CPUs or "max 100000"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(cpus, 1)
+
+def prepare_worker_metrics():
+    """Give the workers an empty PROMETHEUS_MULTIPROC_DIR; it must be set before they import prometheus_client"""
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR") or tempfile.mkdtemp(prefix="chat-metrics-")
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            os.remove(os.path.join(path, name))
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=5000)
+    # Each worker is a separate process with its own REPLICA_ID, so workers
+    # find each other's users through the presence registry and relay over
+    # Redis exactly as separate pods do
+    workers = worker_count()
+    if workers > 1:
+        prepare_worker_metrics()
+    uvicorn.run("server:app", host="0.0.0.0", port=5000, workers=workers, ws=ChatWebSocketProtocol,
+                ws_max_size=MAX_FRAME_BYTES, ws_per_message_deflate=WS_COMPRESSION)
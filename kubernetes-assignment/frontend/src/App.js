@@ -128,7 +128,13 @@ function App() {
     cleanupWebSocket();
     
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    const wsUrl = `${protocol}//${window.location.host}/ws/${id}`;
+    // One device ID per tab, so a reconnect replaces this tab's old connection
+    let deviceId = sessionStorage.getItem('chatDeviceId');
+    if (!deviceId) {
+      deviceId = Math.random().toString(36).slice(2, 10);
+      sessionStorage.setItem('chatDeviceId', deviceId);
+    }
+    const wsUrl = `${protocol}//${window.location.host}/ws/${id}?device=${deviceId}`;
     
     console.log(`Connecting to WebSocket at: ${wsUrl}`);
     
@@ -141,7 +147,10 @@ function App() {
         setConnected(true);
         setReconnecting(false);
         isConnectingRef.current = false;
-        
+
+        // Ask to be told when the other user comes online or goes offline
+        ws.send(JSON.stringify({ type: 'watch', users: [id === 'A' ? 'B' : 'A'] }));
+
         // Add ping interval to keep connection alive
         const pingInterval = setInterval(() => {
           if (ws.readyState === WebSocket.OPEN) {
@@ -160,14 +169,59 @@ function App() {
         console.log('WebSocket message received:', event.data);
         
         try {
-          const data = JSON.parse(event.data);
+          const parsed = JSON.parse(event.data);
+
+          // With coalescing enabled the server may batch chat messages into one array frame
+          if (Array.isArray(parsed)) {
+            console.log(`Received ${parsed.length} messages in one frame`);
+            setMessages(prevMessages => [...prevMessages, ...parsed.filter(
+              batched => !prevMessages.some(
+                msg => msg.timestamp === batched.timestamp &&
+                      msg.from === batched.from &&
+                      msg.text === batched.text
+              )
+            ).map(batched => ({
+              from: batched.from,
+              text: batched.text,
+              timestamp: batched.timestamp
+            }))]);
+            return;
+          }
+
+          const data = parsed;
           
-          // Ignore ping/pong messages
-          if (data.type === 'ping' || data.type === 'pong') {
+          // Answer server heartbeats so the backend keeps the connection open
+          if (data.type === 'ping') {
+            ws.send(JSON.stringify({ type: 'pong' }));
+            return;
+          }
+
+          // Ignore pong replies to our own pings
+          if (data.type === 'pong') {
             console.log('Received ping/pong message');
             return;
           }
-          
+
+          // Messages that were queued while we were offline arrive in one batch
+          if (data.type === 'pending') {
+            console.log(`Received ${data.messages.length} queued messages`);
+            setMessages(prevMessages => {
+              const fresh = data.messages.filter(
+                queued => !prevMessages.some(
+                  msg => msg.timestamp === queued.timestamp &&
+                        msg.from === queued.from &&
+                        msg.text === queued.text
+                )
+              );
+              return [...prevMessages, ...fresh.map(queued => ({
+                from: queued.from,
+                text: queued.text,
+                timestamp: queued.timestamp
+              }))];
+            });
+            return;
+          }
+
           // Handle system messages
           if (data.from === 'system') {
             console.log('System message:', data.text);
@@ -1,6 +1,9 @@
 from flask import Flask
+from request_profiler import RequestProfiler
 
 app = Flask(__name__)
+# Per-route latency and sampled flamegraphs on /_profiler
+RequestProfiler(app)
 
 @app.route('/')
 def home():